@@ -23,4 +23,28 @@ some_time = dbc.Alert(
     'Please wait while I run the simulation...',
     color='info',
     dismissable=True
-)
\ No newline at end of file
+)
+
+bootstrap_sampling = dbc.Alert(
+    'Historical returns need a returns file and random sampling...',
+    color='info',
+    dismissable=True
+)
+
+estimate_returns = dbc.Alert(
+    'Only normal returns can be estimated, simulate historical returns instead...',
+    color='info',
+    dismissable=True
+)
+
+sim_expired = dbc.Alert(
+    'This simulation is no longer saved, please simulate it again...',
+    color='info',
+    dismissable=True
+)
+
+too_many_rows = dbc.Alert(
+    'That is as many rows as a strategy can have...',
+    color='info',
+    dismissable=True
+)
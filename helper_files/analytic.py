@@ -0,0 +1,80 @@
+from statistics import NormalDist
+
+import numpy as np
+
+from helper_files.financial_calcs import TIMESTEPS, get_asset_model, get_batch_apr, get_correlation, \
+    get_monthly_lognormal, get_yearly_strategy
+from helper_files.simulation import Depletion, split_options
+
+# the percentiles an estimate gives, the same as a simulation's summary
+ESTIMATE_PERCENTILES = [10, 25, 50, 75, 90]
+
+
+def get_estimate(model, options=None):
+    # the distribution of the final total without simulating any trials - exact when nothing is random, otherwise a
+    # lognormal with the exact mean and variance the normal returns model gives the final total
+    # None for the historical returns, which have no closed form
+    # the drawdown is only worked out when it's exact, as it isn't a function of the final total's moments
+    options = options or {}
+    if options.get('returns', 'normal') != 'normal':
+        return None
+    principal, strat_ages, monthly, weights, means, cov = get_asset_model(model)
+    timestep = options.get('timestep', 'yearly')
+    yearly_conts, yearly_weights = get_yearly_strategy(strat_ages, monthly, weights, timestep)
+    growth_means, growth_squares = get_growth_moments(yearly_weights, means, cov, timestep)
+
+    # each step's growth is independent of the total it grows, so the first two moments carry through exactly
+    mean = float(principal)
+    square = mean ** 2
+    for cont, growth_mean, growth_square in zip(yearly_conts, growth_means, growth_squares):
+        square = (square + 2 * cont * mean + cont ** 2) * growth_square
+        mean = (mean + cont) * growth_mean
+    exact = not np.any(np.diag(np.asarray(cov, dtype=float)))
+    variance = 0.0 if exact else max(square - mean ** 2, 0.0)
+    totals = get_lognormal_percentiles(mean, variance, ESTIMATE_PERCENTILES)
+
+    # the annualised return only grows with the final total, so its percentiles are the totals' percentiles'
+    payment_coeffs = yearly_conts.copy()
+    payment_coeffs[0] += principal
+    aprs = get_batch_apr(payment_coeffs, totals, steps_per_year=TIMESTEPS[timestep])
+    return {'exact': exact,
+            'mean': mean,
+            'sd': variance ** 0.5,
+            'percentiles': dict(zip(ESTIMATE_PERCENTILES, totals.tolist())),
+            'aprs': dict(zip(ESTIMATE_PERCENTILES, aprs.tolist())),
+            'total_paid_in': float(yearly_conts.sum()),
+            'drawdown': get_exact_drawdown(model, options) if exact else None}
+
+
+def get_exact_drawdown(model, options):
+    # with nothing random every trial runs out at the same age, so one trial is all of them
+    model_options, drawdown = split_options(options)
+    depletion = Depletion(drawdown, model[1][-1])
+    depletion.update(0, 0, 1, 1, model, model_options)
+    return depletion.summary()
+
+
+def get_growth_moments(yearly_weights, means, cov, timestep='yearly'):
+    # the mean and mean square of the portfolio's growth over each step
+    means = np.asarray(means, dtype=float)
+    cov = np.asarray(cov, dtype=float)
+    if timestep == 'yearly':
+        asset_means = 1 + means / 100
+        products = np.outer(asset_means, asset_means) + cov / 100 ** 2
+    else:
+        # lognormal monthly growth, E[e^x e^y] = E[e^x] E[e^y] e^cov(x, y)
+        sds = np.sqrt(np.diag(cov))
+        log_means, log_sds, log_corr = get_monthly_lognormal(means, sds, get_correlation(cov, sds))
+        log_cov = np.outer(log_sds, log_sds) * log_corr
+        asset_means = np.exp(log_means + np.diag(log_cov) / 2)
+        products = np.outer(asset_means, asset_means) * np.exp(log_cov)
+    return yearly_weights @ asset_means, np.einsum('si,ij,sj->s', yearly_weights, products, yearly_weights)
+
+
+def get_lognormal_percentiles(mean, variance, percentiles):
+    if mean <= 0 or variance == 0:
+        return np.full(len(percentiles), max(mean, 0.0))
+    sigma = np.sqrt(np.log(1 + variance / mean ** 2))
+    mu = np.log(mean) - sigma ** 2 / 2
+    z = np.array([NormalDist().inv_cdf(percentile / 100) for percentile in percentiles])
+    return np.exp(mu + sigma * z)
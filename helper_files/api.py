@@ -0,0 +1,225 @@
+import numpy as np
+
+from helper_files.financial_calcs import TIMESTEPS, get_asset_growth, get_asset_model, get_histogram
+from helper_files.simulation import RETURN_MODELS, SAMPLING_SCHEMES, TIMESTEP_LABELS, get_options, \
+    get_or_run_scenarios, get_sweep_models, split_options
+
+# POST /api/simulate takes one scenario, or {"scenarios": [...]} with any of the run settings alongside, e.g.
+# {"n_trials": 10000, "seed": 1, "sampling": "iid", "timestep": "yearly", "returns": "normal",
+#  "percentiles": [10, 50, 90], "bins": 20, "trim": 0.05,
+#  "scenarios": [{"principal": 1000, "end_age": 60, "strategy": [{"age": 30, "monthly": 100, "bonds": 30},
+#                                                                {"age": 40, "monthly": 200, "bonds": 70}],
+#                 "bond_gain": 4.5, "bond_sd": 4.5, "stock_gain": 10, "stock_sd": 20}]}
+# with "bond_grid": [0, 5, ..., 100] a single scenario is swept over those static bond %s instead, every one
+# of them over the same trials
+# a scenario can hold any number of assets in place of bonds and stocks, e.g.
+# {"principal": 1000, "end_age": 60,
+#  "assets": [{"gain": 4.5, "sd": 4.5}, {"gain": 10, "sd": 20}, {"gain": 7, "sd": 15}],
+#  "correlation": [[1, -0.2, 0.1], [-0.2, 1, 0.6], [0.1, 0.6, 1]],
+#  "strategy": [{"age": 30, "monthly": 100, "weights": [20, 50, 30]}]}
+# where the weights are the % in each asset and the correlation defaults to none
+# with "drawdown": {"rate": 5, "until": 95} every trial then withdraws 5% of its final total a year until 95,
+# and each scenario reports how likely the money is to run out first and at what ages it does
+MAX_SCENARIOS = 100
+MAX_ASSETS = 20
+MAX_API_TRIALS = 1000000
+# every scenario runs over the same trials in one batch inside the request, this caps the steps the batch simulates
+# (trials x scenarios x years, or months) to a few seconds of work, well inside the gunicorn worker timeout
+MAX_API_TRIAL_STEPS = 50000000
+DEFAULTS = {'n_trials': 10000, 'seed': None, 'sampling': 'iid', 'timestep': 'yearly', 'returns': 'normal',
+            'percentiles': [10, 25, 50, 75, 90], 'bins': 20, 'trim': 0.05}
+# the same defaults as the gain and volatility cards
+MODEL_DEFAULTS = {'bond_gain': 4.5, 'bond_sd': 4.5, 'stock_gain': 10, 'stock_sd': 20}
+
+
+class ApiError(ValueError):
+    pass
+
+
+def simulate(body):
+    if not isinstance(body, dict):
+        raise ApiError('The request body must be a JSON object')
+    scenarios = body.get('scenarios', [body])
+    if not isinstance(scenarios, list) or not 1 <= len(scenarios) <= MAX_SCENARIOS:
+        raise ApiError('scenarios must be a list of 1 to {} scenarios'.format(MAX_SCENARIOS))
+    bond_grid = body.get('bond_grid')
+    if bond_grid is not None:
+        if len(scenarios) != 1:
+            raise ApiError('bond_grid sweeps a single scenario')
+        if not isinstance(bond_grid, list) or not 1 <= len(bond_grid) <= MAX_SCENARIOS or \
+                not all(is_number(bonds) and 0 <= bonds <= 100 for bonds in bond_grid):
+            raise ApiError('bond_grid must be a list of 1 to {} numbers from 0 to 100'.format(MAX_SCENARIOS))
+    n_trials = get_number(body, 'n_trials', 1, MAX_API_TRIALS, integer=True, default=DEFAULTS['n_trials'])
+    seed = get_number(body, 'seed', 0, 2 ** 32 - 1, integer=True, default=DEFAULTS['seed'])
+    sampling = body.get('sampling', DEFAULTS['sampling'])
+    if sampling not in SAMPLING_SCHEMES:
+        raise ApiError('sampling must be one of ' + ', '.join(SAMPLING_SCHEMES))
+    timestep = body.get('timestep', DEFAULTS['timestep'])
+    if timestep not in TIMESTEP_LABELS:
+        raise ApiError('timestep must be one of ' + ', '.join(TIMESTEP_LABELS))
+    returns = body.get('returns', DEFAULTS['returns'])
+    if returns not in RETURN_MODELS:
+        raise ApiError('returns must be one of ' + ', '.join(RETURN_MODELS))
+    drawdown = get_drawdown(body)
+    options = get_options(sampling, timestep, returns, drawdown)
+    percentiles = body.get('percentiles', DEFAULTS['percentiles'])
+    if not isinstance(percentiles, list) or not all(is_number(p) and 0 <= p <= 100 for p in percentiles):
+        raise ApiError('percentiles must be a list of numbers from 0 to 100')
+    bins = get_number(body, 'bins', 1, 200, integer=True, default=DEFAULTS['bins'])
+    trim = get_number(body, 'trim', 0, 0.49, default=DEFAULTS['trim'])
+    models = [get_model(scenario, i) for i, scenario in enumerate(scenarios)]
+    for i, model in enumerate(models):
+        check_market(model, options, 'scenario {}: '.format(i))
+        if drawdown is not None and drawdown['until'] <= model[1][-1]:
+            raise ApiError('scenario {}: drawdown until must be after end_age'.format(i))
+    if bond_grid is not None:
+        if len(models[0]) != 8:
+            raise ApiError('bond_grid sweeps a bond and stock scenario')
+        models = get_sweep_models(models[0], bond_grid)
+    if n_trials * get_steps(models, options) > MAX_API_TRIAL_STEPS:
+        raise ApiError('n_trials times the years simulated across all the scenarios (months with a monthly timestep) '
+                       'must be at most {:,}'.format(MAX_API_TRIAL_STEPS))
+
+    sims = get_or_run_scenarios(n_trials, models, seed, options)
+    return {'n_trials': n_trials,
+            'sampling': sampling,
+            'timestep': timestep,
+            'returns': returns,
+            'scenarios': [summarise(sim, model, percentiles, bins, trim) for sim, model in zip(sims, models)]}
+
+
+def get_steps(models, options):
+    # the steps each trial takes across every scenario, drawdown included
+    model_options, drawdown = split_options(options)
+    steps = 0
+    for model in models:
+        strat_ages = model[1]
+        steps += (drawdown['until'] if drawdown is not None else strat_ages[-1]) - strat_ages[0]
+    return steps * TIMESTEPS[model_options.get('timestep', 'yearly')]
+
+
+def summarise(sim, model, percentiles, bins, trim):
+    edges, counts = get_histogram(sim['totals'], trim, bins)
+    allocation = {'bonds': model[3]} if len(model) == 8 else {'weights': (np.array(model[3]) * 100).round(10).tolist()}
+    return {'seed': sim['seed'],
+            'total_paid_in': sim['total_paid_in'],
+            'principal': model[0],
+            **allocation,
+            'percentiles': get_percentiles(sim['totals'], percentiles),
+            'apr_percentiles': get_percentiles(sim['aprs'], percentiles),
+            'standard_errors': {str(p): none_if_nan(se) for p, se in sim['standard_errors'].items()},
+            'rank_error': sim['totals'].rank_error,
+            'drawdown': summarise_drawdown(sim.get('drawdown')),
+            'histogram': {'edges': edges.tolist(), 'counts': counts.tolist()}}
+
+
+def summarise_drawdown(drawdown):
+    if drawdown is None:
+        return None
+    return {'rate': drawdown['rate'] * 100,
+            'until': drawdown['until'],
+            'ruin_probability': drawdown['ruin_probability'],
+            'depletion_ages': {str(drawdown['start_age'] + year): count
+                               for year, count in enumerate(drawdown['depleted']) if count}}
+
+
+def get_drawdown(body):
+    drawdown = body.get('drawdown')
+    if drawdown is None:
+        return None
+    if not isinstance(drawdown, dict):
+        raise ApiError('drawdown must be a JSON object with rate and until')
+    rate = get_number(drawdown, 'rate', 0, 100, where='drawdown: ', required=True)
+    until = get_number(drawdown, 'until', 0, 120, integer=True, where='drawdown: ', required=True)
+    return {'rate': rate / 100, 'until': until}
+
+
+def get_percentiles(quantiles, percentiles):
+    if not percentiles:
+        return {}
+    values = quantiles.percentiles(percentiles)
+    return {'{:g}'.format(p): none_if_nan(value) for p, value in zip(percentiles, values)}
+
+
+def get_model(scenario, index):
+    # the same checks the main callback makes on the strategy card
+    where = 'scenario {}: '.format(index)
+    if not isinstance(scenario, dict):
+        raise ApiError(where + 'must be a JSON object')
+    principal = get_number(scenario, 'principal', 0, None, where=where, required=True)
+    end_age = get_number(scenario, 'end_age', 0, 120, integer=True, where=where, required=True)
+    strategy = scenario.get('strategy')
+    if not isinstance(strategy, list) or not strategy or not all(isinstance(row, dict) for row in strategy):
+        raise ApiError(where + 'strategy must be a list of rows with age, monthly and bonds (or weights)')
+    strat_ages = [get_number(row, 'age', 0, 120, integer=True, where=where, required=True) for row in strategy]
+    monthly = [float(get_number(row, 'monthly', 0, None, where=where, required=True)) for row in strategy]
+    strat_ages.append(end_age)
+    if any(a >= b for a, b in zip(strat_ages[:-1], strat_ages[1:])):
+        raise ApiError(where + 'strategy ages must be increasing and before end_age')
+    if 'assets' in scenario:
+        return (float(principal), strat_ages, monthly, *get_assets(scenario, strategy, where))
+    bond_vals = [get_number(row, 'bonds', 0, 100, where=where, required=True) for row in strategy]
+    gains = [get_number(scenario, name, None, None, where=where, default=MODEL_DEFAULTS[name])
+             for name in ['stock_gain', 'stock_sd', 'bond_gain', 'bond_sd']]
+    if gains[1] < 0 or gains[3] < 0:
+        raise ApiError(where + 'stock_sd and bond_sd must not be negative')
+    return (float(principal), strat_ages, monthly, bond_vals, *gains)
+
+
+def get_assets(scenario, strategy, where):
+    # the weights, means and covariance of an asset model
+    assets = scenario['assets']
+    if not isinstance(assets, list) or not 1 <= len(assets) <= MAX_ASSETS or \
+            not all(isinstance(asset, dict) for asset in assets):
+        raise ApiError(where + 'assets must be a list of 1 to {} assets with a gain and sd'.format(MAX_ASSETS))
+    means = [float(get_number(asset, 'gain', None, None, where=where, required=True)) for asset in assets]
+    sds = np.array([get_number(asset, 'sd', 0, None, where=where, required=True) for asset in assets], dtype=float)
+    correlation = scenario.get('correlation', np.eye(len(assets)).tolist())
+    if not isinstance(correlation, list) or len(correlation) != len(assets) or \
+            not all(isinstance(row, list) and len(row) == len(assets) and
+                    all(is_number(value) and -1 <= value <= 1 for value in row) for row in correlation):
+        raise ApiError(where + 'correlation must have a row and a column of numbers from -1 to 1 for every asset')
+    correlation = np.array(correlation, dtype=float)
+    if not np.array_equal(correlation, correlation.T) or np.any(np.diag(correlation) != 1):
+        raise ApiError(where + 'correlation must be symmetric with ones down the diagonal')
+
+    weights = []
+    for row in strategy:
+        row_weights = row.get('weights')
+        if not isinstance(row_weights, list) or len(row_weights) != len(assets) or \
+                not all(is_number(weight) and 0 <= weight <= 100 for weight in row_weights) or \
+                abs(sum(row_weights) - 100) > 1e-6:
+            raise ApiError(where + 'every strategy row needs weights from 0 to 100 for every asset, adding up to 100')
+        weights.append([weight / 100 for weight in row_weights])
+    return weights, means, (np.outer(sds, sds) * correlation).tolist()
+
+
+def check_market(model, options, where):
+    # a single trial of a single year finds any market the engine can't draw from
+    principal, strat_ages, monthly, weights, means, cov = get_asset_model(model)
+    try:
+        get_asset_growth(1, 1, means, cov, np.random.default_rng(0), **split_options(options)[0])
+    except ValueError as error:
+        raise ApiError(where + str(error))
+
+
+def get_number(values, name, minimum, maximum, integer=False, where='', required=False, default=None):
+    if name not in values or values[name] is None:
+        if required:
+            raise ApiError(where + name + ' is required')
+        return default
+    value = values[name]
+    if not is_number(value) or (integer and value != int(value)):
+        raise ApiError(where + name + (' must be a whole number' if integer else ' must be a number'))
+    if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+        raise ApiError(where + '{} must be between {} and {}'.format(name, minimum, maximum if maximum is not None
+                                                                      else 'infinity'))
+    return int(value) if integer else value
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and np.isfinite(value)
+
+
+def none_if_nan(value):
+    return None if np.isnan(value) else float(value)
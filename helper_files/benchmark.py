@@ -0,0 +1,219 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from helper_files import history, sim_cache
+from helper_files.div_templates import get_summary_of_sim
+from helper_files.financial_calcs import Calculator, get_batch_apr, make_box, make_histo, simple_calc, simulate_blocks
+from helper_files.simulation import get_n_blocks, get_options, get_or_run_scenarios, get_sweep_models
+
+# run with `python -m helper_files.benchmark --output bench.json --baseline old_bench.json`
+HORIZONS = [10, 20, 40, 80]
+ROW_COUNTS = [1, 3, 6]
+TRIAL_COUNTS = [1000, 10000, 100000]
+CALLBACK_TRIAL_COUNTS = [10000, 100000]
+START_AGE = 30
+SEED = 1
+# a benchmark has regressed if its median is this much slower than the baseline's...
+THRESHOLD = 0.25
+# ...and slower by more than this many seconds, so timer noise on tiny benchmarks doesn't count
+NOISE_FLOOR = 0.001
+
+
+def get_strategy(horizon, n_rows):
+    # n_rows phases spread evenly over the horizon, each with more monthly and fewer bonds than the last
+    strat_ages = np.linspace(START_AGE, START_AGE + horizon, n_rows + 1).astype(int).tolist()
+    monthly = [100.0 * (row + 1) for row in range(n_rows)]
+    bond_vals = np.linspace(80, 20, n_rows).round().tolist() if n_rows > 1 else [50.0]
+    return strat_ages, monthly, bond_vals
+
+
+def get_model(horizon, n_rows):
+    strat_ages, monthly, bond_vals = get_strategy(horizon, n_rows)
+    return 1000.0, strat_ages, monthly, bond_vals, 10, 20, 4.5, 4.5
+
+
+def get_benchmarks():
+    # name -> (function that makes the function to time, function run untimed before each repeat)
+    # the functions to time are only made for the benchmarks that are run, as some take a while to set up
+    benchmarks = {}
+    for horizon in HORIZONS:
+        for n_rows in ROW_COUNTS:
+            model = get_model(horizon, n_rows)
+            case = 'years={},rows={}'.format(horizon, n_rows)
+            benchmarks['simple_calc[{}]'.format(case)] = (lambda model=model: lambda: simple_calc(*model, seed=SEED),
+                                                          None)
+            benchmarks['Calculator[{}]'.format(case)] = \
+                (lambda model=model: lambda: Calculator(*model, seed=SEED).get_records(), None)
+            benchmarks['get_batch_apr[{},trials=10000]'.format(case)] = \
+                (lambda model=model: make_batch_apr(model, 10000), None)
+            for n_trials in TRIAL_COUNTS:
+                benchmarks['get_summary_of_sim[{},trials={}]'.format(case, n_trials)] = \
+                    (lambda model=model, n_trials=n_trials: lambda: get_summary_of_sim(n_trials, *model, seed=SEED),
+                     sim_cache.clear)
+
+    for n_trials in TRIAL_COUNTS:
+        benchmarks['sweep[years=40,rows=3,trials={}]'.format(n_trials)] = \
+            (lambda n_trials=n_trials: lambda: get_or_run_scenarios(n_trials, get_sweep_models(get_model(40, 3)),
+                                                                    SEED),
+             sim_cache.clear)
+        benchmarks['get_summary_of_sim[years=40,rows=3,trials={},bootstrap]'.format(n_trials)] = \
+            (lambda n_trials=n_trials: lambda: get_summary_of_sim(n_trials, *get_model(40, 3), seed=SEED,
+                                                                  options=get_options(returns='bootstrap')),
+             sim_cache.clear)
+        benchmarks['get_summary_of_sim[years=50,rows=3,trials={},monthly]'.format(n_trials)] = \
+            (lambda n_trials=n_trials: lambda: get_summary_of_sim(n_trials, *get_model(50, 3), seed=SEED,
+                                                                  options=get_options(timestep='monthly')),
+             sim_cache.clear)
+        benchmarks['make_histo[trials={}]'.format(n_trials)] = \
+            (lambda n_trials=n_trials: make_figure(make_histo, n_trials), None)
+        benchmarks['make_box[trials={}]'.format(n_trials)] = \
+            (lambda n_trials=n_trials: make_figure(make_box, n_trials), None)
+
+    for n_trials in CALLBACK_TRIAL_COUNTS:
+        benchmarks['simulate_callback[years=40,rows=3,trials={}]'.format(n_trials)] = \
+            (lambda n_trials=n_trials: make_simulate_callback(n_trials, 40, 3), sim_cache.clear)
+    benchmarks['simulate_callback[years=50,rows=3,trials=10000,monthly]'] = \
+        (lambda: make_simulate_callback(10000, 50, 3, 'monthly'), sim_cache.clear)
+    return benchmarks
+
+
+def make_batch_apr(model, n_trials):
+    # the annualised returns of a batch of trials, as the simulation works them out
+    final_totals, total_paid_in, payment_coeffs = simulate_blocks(SEED, 0, get_n_blocks(n_trials), n_trials, model)
+    return lambda: get_batch_apr(payment_coeffs, final_totals)
+
+
+def make_figure(make, n_trials):
+    sim = get_summary_of_sim(n_trials, *get_model(40, 3), seed=SEED)[1]
+    return lambda: make(sim['totals'])
+
+
+def make_simulate_callback(n_trials, horizon, n_rows, timestep='yearly'):
+    # imported here as the app is slow to import and needs the repo root on the path
+    import main as app
+    return lambda: run_simulate_callback(app, n_trials, horizon, n_rows, timestep)
+
+
+def run_simulate_callback(app, n_trials, horizon, n_rows, timestep='yearly'):
+    # the whole round trip a browser makes - the simulate click, polls until the run is done, then its views
+    client = app.server.test_client()
+    strat_ages, monthly, bond_vals = get_strategy(horizon, n_rows)
+    end_age = strat_ages.pop()
+    strategy = [{'age': age, 'monthly': value, 'bonds': bonds}
+                for age, value, bonds in zip(strat_ages, monthly, bond_vals)]
+    state = [get_state('principal', '1000'), get_state('strategy', strategy, 'data'), get_state('end-age', end_age),
+             get_state('bond-gain', 4.5), get_state('bond-sd', 4.5), get_state('stock-gain', 10),
+             get_state('stock-sd', 20), get_state('seed', SEED),
+             get_state('num-trials', n_trials), get_state('sampling', 'iid'), get_state('timestep', timestep),
+             get_state('returns', 'normal'), get_state('withdrawal', 5),
+             get_state('until-age', 95), get_state('precision', None),
+             get_state('sim-job', None)]
+    inputs = [get_state('calculate', 0, 'n_clicks'), get_state('simulate', 1, 'n_clicks'),
+              get_state('sim-poll', None, 'n_intervals'), get_state('sweep', 0, 'n_clicks'),
+              get_state('estimate', 0, 'n_clicks')]
+    body = {'output': '..' + '...'.join(app.MAIN_OUTPUTS) + '..', 'outputs': None, 'inputs': inputs,
+            'state': state, 'changedPropIds': ['simulate.n_clicks']}
+    while True:
+        response = client.post('/_dash-update-component', data=json.dumps(body), content_type='application/json')
+        if response.status_code != 200:
+            raise RuntimeError('callback failed with status {}'.format(response.status_code))
+        outputs = json.loads(response.data)['response']
+        if outputs.get('sim-run', {}).get('data'):
+            return run_view_callback(client, outputs['sim-run']['data'])
+        if outputs.get('sim-poll', {}).get('disabled'):
+            raise RuntimeError('simulation job failed')
+        if 'sim-job' in outputs:
+            state[-1]['value'] = outputs['sim-job']['data']
+        body['changedPropIds'] = ['sim-poll.n_intervals']
+        time.sleep(0.01)
+
+
+def run_view_callback(client, sim_run):
+    inputs = [get_state('sim-run', sim_run, 'data'), get_state('view-bins', 20), get_state('view-trim', 5),
+              get_state('view-tail', 10)]
+    body = {'output': '..sim-statement.children...histo.figure...box.figure...sim-export.children..', 'outputs': None,
+            'inputs': inputs, 'state': [], 'changedPropIds': ['sim-run.data']}
+    response = client.post('/_dash-update-component', data=json.dumps(body), content_type='application/json')
+    if response.status_code != 200:
+        raise RuntimeError('view callback failed with status {}'.format(response.status_code))
+
+
+def get_state(id, value, property='value'):
+    return {'id': id, 'property': property, 'value': value}
+
+
+def time_benchmark(function, setup, repeat):
+    times = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+    return {'median': statistics.median(times), 'min': min(times), 'mean': statistics.mean(times),
+            'repeat': repeat}
+
+
+def compare(results, baseline, threshold=THRESHOLD):
+    comparison = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        old, new = baseline[name]['median'], result['median']
+        comparison[name] = {'baseline': old, 'median': new, 'ratio': new / old if old else np.inf,
+                            'regressed': new > old * (1 + threshold) and new - old > NOISE_FLOOR}
+    return comparison
+
+
+def get_environment():
+    return {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+            'cpus': os.cpu_count(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Time the simulator across horizons, strategy rows and trials.')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='compare against the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help='fractional slowdown of the median that counts as a regression')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--filter', default='', help='only run benchmarks with this in their name')
+    args = parser.parse_args(args)
+
+    # the cache lives somewhere private so every timed simulation is a miss
+    sim_cache.CACHE_DIR = tempfile.mkdtemp(prefix='invest_sim_bench')
+    # the bootstrap benchmarks time the resampling, not the data, so they run on made up returns
+    history.HISTORY_FILE = os.path.join(sim_cache.CACHE_DIR, 'returns.npy')
+    os.environ['SIM_HISTORY_FILE'] = history.HISTORY_FILE
+    np.save(history.HISTORY_FILE, np.random.default_rng(SEED).normal([4.5, 10], [4.5, 20], (100, 2)))
+    results = {}
+    for name, (make, setup) in get_benchmarks().items():
+        if args.filter in name:
+            results[name] = time_benchmark(make(), setup, args.repeat)
+            print('{:<60} {:>10.2f} ms'.format(name, results[name]['median'] * 1000))
+
+    report = {'environment': get_environment(), 'results': results}
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+        report['comparison'] = compare(results, baseline, args.threshold)
+        regressions = [name for name, row in report['comparison'].items() if row['regressed']]
+        for name, row in report['comparison'].items():
+            print('{:<60} {:>8.2f}x{}'.format(name, row['ratio'], '  REGRESSED' if row['regressed'] else ''))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,11 +1,17 @@
 import numpy as np
-import pandas as pd
 
 import dash_bootstrap_components as dbc
 import dash_core_components as dcc
 import dash_html_components as html
 
-from helper_files.financial_calcs import simple_calc
+from helper_files.simulation import SAMPLING_SCHEMES, run_simulation, get_sim_key
+from helper_files import sim_cache
+
+STATEMENT_PERCENTILES = [10, 25, 50, 75, 90]
+# the chance of ending up below the lower card, and above the upper one, in %
+TAIL_PERCENTILES = [1, 5, 10, 20]
+# strategy rows go in this many fixed slots, the newest row in the top slot
+MAX_STRATEGY_ROWS = 20
 
 
 def input_card(title,text, colour, id):
@@ -92,7 +98,8 @@ def strategy_card(title, colour):
                                     dbc.Col(dbc.Button('Add', color="light", id='add-strat-row', n_clicks=0), width=3),
                                     dbc.Col(dbc.Button('Remove', color="dark", id='remove-strat-row', n_clicks=0), width=3)
                                 ]),
-                        ])
+                        ]),
+                        html.Div(id='strategy-row-alert'),
                     ]
                 ),
                 dbc.Row(
@@ -103,7 +110,9 @@ def strategy_card(title, colour):
                         dbc.Col('Stock (%)')
                      ],
                 ),
-                dbc.Row(dbc.Col(html.Div(strategy_row(0, None, 0), id='strategy-rows'))),
+                dbc.Row(dbc.Col(html.Div([html.Div(strategy_row(0, None, 0) if index == 0 else [],
+                                                   id={'type': 'strategy-slot', 'index': index})
+                                          for index in reversed(range(MAX_STRATEGY_ROWS))], id='strategy-rows'))),
                 dbc.Row(
                     [
 
@@ -123,7 +132,6 @@ def strategy_row(index, age, monthly):
     row = [html.Div(
         [
             html.Div([], id={'type': 'bond-value-alert', 'index': index}),
-            html.Div([], id='strategy-row-alert'),
          dbc.Row(
         [
             dbc.Col(dbc.Input(type="number", placeholder='Years...', min=0, max=120, step=1,
@@ -139,7 +147,7 @@ def strategy_row(index, age, monthly):
 
 
 def get_concluding_statement(financial_data, end_age):
-    last_phase_value = financial_data.get_last_phase().get_last_total()
+    last_phase_value = financial_data.get_last_total()
     monthly_int = last_phase_value * 0.05 / 12
     top = '{}'.format(end_age)
     value = '${:,.2f}'.format(last_phase_value)
@@ -156,41 +164,67 @@ def get_concluding_statement(financial_data, end_age):
     ])
     return conc
 
-def get_summary_of_sim(n_times, principal, strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd):
-    totals = []
-    total_paid_in = 0
-    for i in range(n_times):
-        yearly_totals, total_paid_in, payment_coeffs = simple_calc(float(principal), strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd)
-        payment_coeffs.append(yearly_totals[-1] * -1)
-        totals.append([yearly_totals[-1], payment_coeffs])
+def get_summary_of_sim(n_times, principal, strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd,
+                       seed=None, options=None, tolerance=None):
+    # identical inputs are only simulated once across all the workers
+    # with a tolerance (e.g. 0.01 for 1%) n_times is the most trials that will be run
+    model = (float(principal), strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd)
+    sim = sim_cache.get_or_compute(get_sim_key(n_times, model, seed, options, tolerance),
+                                   lambda: run_simulation(n_times, *model, seed=seed, options=options,
+                                                          tolerance=tolerance))
+    return summarise_sim(sim, principal, strat_ages[-1]), sim
+
+
+def summarise_sim(sim, principal, end_age, tail=10):
+    # incomes are the drawdown's share of each total, 5% a year without one
+    drawdown = sim.get('drawdown')
+    rate = drawdown['rate'] if drawdown is not None else 0.05
+    n_times = '{:,.2f}'.format(int(sim['n_trials']))
+    details = [html.Span('The simulation was ran...'),
+               html.Span([html.Span(n_times, id='age-statement', style={'color': 'green', 'font-size': '20px'})]),
+               html.Div('Seed: {}'.format(sim['seed']), style={'font-size': '12px'}),
+               html.Div('Sampling: ' + SAMPLING_SCHEMES[sim['options'].get('sampling', 'iid')],
+                        style={'font-size': '12px'}),
+               html.Div(get_standard_error_text(sim['standard_errors']), style={'font-size': '12px'}),
+               html.Div(get_precision_text(sim['precision'], sim['tolerance']), style={'font-size': '12px'}),
+               html.Div('Percentiles are within {:.2f}% (of rank) of exact'.format(sim['totals'].rank_error * 100),
+                        style={'font-size': '12px'}) if sim['totals'].rank_error else None]
+    percentiles = get_statement_percentiles(tail)
+    return get_outcome_statement(sim['totals'].percentiles(percentiles), sim['aprs'].percentiles(percentiles),
+                                 sim['total_paid_in'], principal, end_age, rate, details, drawdown, tail)
+
+
+def summarise_estimate(estimate, principal, end_age, rate=0.05, provisional=False):
+    # provisional while a simulation of the same inputs runs, its statement replaces this one
+    if provisional:
+        details = [html.Span('Provisional estimate...'),
+                   html.Div(dcc.Markdown('from a lognormal with the exact mean and spread of the final total, while '
+                                         'the simulation runs'), style={'font-size': '12px'})]
+    elif estimate['exact']:
+        details = [html.Span('Nothing here is random...'),
+                   html.Div(dcc.Markdown('so every trial would end up with exactly this'), style={'font-size': '12px'})]
+    else:
+        details = [html.Span('Estimated in an instant...'),
+                   html.Div(dcc.Markdown('from a lognormal with the exact mean and spread of the final total - click '
+                                         '__simulate__ for the exact tails'), style={'font-size': '12px'})]
+    return get_outcome_statement([estimate['percentiles'][p] for p in STATEMENT_PERCENTILES],
+                                 [estimate['aprs'][p] for p in STATEMENT_PERCENTILES], estimate['total_paid_in'],
+                                 principal, end_age, rate, details, estimate['drawdown'])
+
+
+def get_statement_percentiles(tail=10):
+    return [tail, 25, 50, 75, 100 - tail]
+
+
+def get_outcome_statement(totals, aprs, total_paid_in, principal, end_age, rate, details, drawdown=None, tail=10):
+    # totals and aprs are the get_statement_percentiles(tail) of the final total and annualised return
     paid_in_plus_principal = total_paid_in + principal
 
-    just_totals = []
-    just_interest = []
-    for total in totals:
-        just_totals.append(total[0])
-        just_interest.append(total[1])
-    just_totals.sort(reverse=True)
-    just_interest.sort(key=lambda x: x[-1])
-
-    median = np.percentile(just_totals, 50)
-    median_apr = get_apr(just_interest[5000])
-    median_apr = '{:,.2f}%'.format(median_apr)
-
-    tenth = np.percentile(just_totals, 10)
-    tenth_apr = '{:,.2f}%'.format(get_apr(just_interest[1000]))
-
-    lower_q = np.percentile(just_totals, 25)
-    lower_q_apr = '{:,.2f}%'.format(get_apr(just_interest[2500]))
-
-    upper_q = np.percentile(just_totals, 75)
-    upper_q_apr = '{:,.2f}%'.format(get_apr(just_interest[7500]))
-
-    ninety = np.percentile(just_totals, 90)
-    ninety_apr = '{:,.2f}%'.format(get_apr(just_interest[9000]))
+    tenth_apr, lower_q_apr, median_apr, upper_q_apr, ninety_apr = ['{:,.2f}%'.format(apr) for apr in aprs]
+    tenth, lower_q, median, upper_q, ninety = totals
 
     median_int = int(median) - paid_in_plus_principal
-    median_income = float(median) * 0.05 / 12
+    median_income = float(median) * rate / 12
     median_income = human_format(median_income)
     median = human_format(median)
     median_int = human_format(median_int)
@@ -198,8 +232,8 @@ def get_summary_of_sim(n_times, principal, strat_ages, monthly, bond_vals, stock
 
     iqr_lower = human_format(lower_q)
     iqr_upper = human_format(upper_q)
-    iqr_l_income = lower_q * 0.05 / 12
-    iqr_u_income = upper_q * 0.05 / 12
+    iqr_l_income = lower_q * rate / 12
+    iqr_u_income = upper_q * rate / 12
     iqr_l = human_format(iqr_l_income)
     iqr_u = human_format(iqr_u_income)
     iqr_income_string = iqr_l + '  -  ' + iqr_u
@@ -209,38 +243,31 @@ def get_summary_of_sim(n_times, principal, strat_ages, monthly, bond_vals, stock
     iqr_int_l = human_format(iqr_int_1)
     iqr_int_u = human_format(iqr_int_2)
     iqr_int_string = iqr_int_l + '  -  ' + iqr_int_u
-    iqr_apr_string = upper_q_apr + '  -  ' + lower_q_apr
+    iqr_apr_string = lower_q_apr + '  -  ' + upper_q_apr
 
 
     lower_10 = human_format(tenth)
-    lower_10_income = float(tenth) * 0.05 / 12
+    lower_10_income = float(tenth) * rate / 12
     lower_10_income = human_format(lower_10_income)
     lower_10_int = int(tenth) - paid_in_plus_principal
     lower_10_int = human_format(lower_10_int)
 
 
     upper_10 = human_format(ninety)
-    upper_10_income = float(ninety) * 0.05 / 12
+    upper_10_income = float(ninety) * rate / 12
     upper_10_income = human_format(upper_10_income)
     upper_10_int = int(ninety) - paid_in_plus_principal
     upper_10_int = human_format(upper_10_int)
 
     total_paid_in = human_format(total_paid_in)
     paid_in_plus_principal = human_format(paid_in_plus_principal)
-    n_times = '{:,.2f}'.format(int(n_times))
-
-    totals_df = pd.DataFrame(just_totals)
 
     concluding_statement = html.Div([
         dbc.Row([
-            dbc.Col(
-                [html.Span('The simulation was ran...'),
-                 html.Span([html.Span(n_times, id='age-statement', style={'color': 'green', 'font-size': '20px'})]),
-                 ], width=4
-            ),
+            dbc.Col(details, width=4),
             dbc.Col(
                 feedback_card(median, median_int, dcc.Markdown('The median (50th percentile) portfolio value is:'), 'Total',
-                              total_paid_in, paid_in_plus_principal, median_income, median_apr, strat_ages[-1]), width=6
+                              total_paid_in, paid_in_plus_principal, median_income, median_apr, end_age, rate), width=6
             )
         ]),
         html.Hr(className="my-2"),
@@ -248,27 +275,107 @@ def get_summary_of_sim(n_times, principal, strat_ages, monthly, bond_vals, stock
             dbc.Col(
                 feedback_card(iqr_string, iqr_int_string, dcc.Markdown('There is a __50%__ chance your portfolio will be worth:'),
                               'Between...',
-                              total_paid_in, paid_in_plus_principal, iqr_income_string, iqr_apr_string, strat_ages[-1]), width={'size': 6, 'offset': 3}
+                              total_paid_in, paid_in_plus_principal, iqr_income_string, iqr_apr_string, end_age, rate),
+                width={'size': 6, 'offset': 3}
             ),
         ),
         dbc.Row([
             dbc.Col(
-                feedback_card(lower_10, lower_10_int, dcc.Markdown('There is a __10%__ chance your portfolio will be worth:'), 'Less than...',
-                              total_paid_in, paid_in_plus_principal, lower_10_income, ninety_apr, strat_ages[-1]), width=6
+                feedback_card(lower_10, lower_10_int,
+                              dcc.Markdown('There is a __{:g}%__ chance your portfolio will be worth:'.format(tail)),
+                              'Less than...',
+                              total_paid_in, paid_in_plus_principal, lower_10_income, tenth_apr, end_age, rate), width=6
             ),
             dbc.Col(
-                feedback_card(upper_10, upper_10_int, dcc.Markdown('There is a __10%__ chance your portfolio will be worth:'),
+                feedback_card(upper_10, upper_10_int,
+                              dcc.Markdown('There is a __{:g}%__ chance your portfolio will be worth:'.format(tail)),
                               'More than...',
-                              total_paid_in, paid_in_plus_principal, upper_10_income, tenth_apr, strat_ages[-1]), width=6
+                              total_paid_in, paid_in_plus_principal, upper_10_income, ninety_apr, end_age, rate), width=6
             )
         ]),
+        dbc.Row(
+            dbc.Col(dcc.Markdown(get_drawdown_text(drawdown)), width=12)
+        ) if drawdown is not None else None,
     ])
 
-    return concluding_statement, totals_df, max(just_totals), just_totals
-
-
-def feedback_card(value, interest, text1, text2, monthly, prin_plus_month, income, apr, end_age):
-    age_string = 'From age __'+str(end_age)+'__...this is 5% of the total value...'
+    return concluding_statement
+
+
+def get_drawdown_text(drawdown):
+    # how likely the income is to run out before the until age, and when it does
+    text = 'Withdrawing {:g}% of the total a year from age {}, the money runs out before age {} in __{:.1f}%__ of ' \
+           'trials'.format(drawdown['rate'] * 100, drawdown['start_age'], drawdown['until'],
+                           drawdown['ruin_probability'] * 100)
+    if drawdown['ruin_probability'] == 0:
+        return text
+    tenth, median, ninety = [drawdown['start_age'] + year
+                             for year in get_count_percentiles(drawdown['depleted'], [10, 50, 90])]
+    return text + ' - when it does, it\'s usually at about {} (10% of those by {}, 90% by {})'.format(median, tenth,
+                                                                                                   ninety)
+
+
+def get_count_percentiles(counts, percentiles):
+    # percentiles of the index, weighted by the counts
+    cumulative = np.cumsum(counts)
+    return [int(np.searchsorted(cumulative, percentile / 100 * cumulative[-1])) for percentile in percentiles]
+
+
+def get_standard_error_text(standard_errors):
+    if np.isnan(standard_errors[50]):
+        return None
+    return 'Standard error: median \u00b1{}, 10th \u00b1{}, 90th \u00b1{}'.format(
+        *[human_format(standard_errors[percentile]) for percentile in [50, 10, 90]])
+
+
+def get_precision_text(precision, tolerance):
+    if not np.isfinite(precision[50]):
+        return None
+    text = '95% confidence: median \u00b1{:.2f}%, 10th \u00b1{:.2f}%, 90th \u00b1{:.2f}%'.format(
+        *[precision[percentile] * 100 for percentile in [50, 10, 90]])
+    if tolerance is not None and max(precision.values()) > tolerance:
+        text += ' (stopped at the trial limit before reaching \u00b1{:.2f}%)'.format(tolerance * 100)
+    return text
+
+
+def get_sweep_table(sims, bond_grid):
+    # a risk/return row for each allocation
+    names = ['Bonds (%)', 'Stocks (%)', '10th percentile', 'Median', '90th percentile', 'Median annualised']
+    if sims[0].get('drawdown') is not None:
+        names.append('Runs out')
+    columns = [{'name': name, 'id': name} for name in names]
+    data = []
+    for sim, bonds in zip(sims, bond_grid):
+        tenth, median, ninety = sim['totals'].percentiles([10, 50, 90])
+        data.append({'Bonds (%)': bonds, 'Stocks (%)': 100 - bonds, '10th percentile': human_format(tenth),
+                     'Median': human_format(median), '90th percentile': human_format(ninety),
+                     'Median annualised': '{:,.2f}%'.format(sim['aprs'].percentiles([50])[0])})
+        if sim.get('drawdown') is not None:
+            data[-1]['Runs out'] = '{:.1f}%'.format(sim['drawdown']['ruin_probability'] * 100)
+    return columns, data
+
+
+def get_progress_message(job):
+    if job['status'] == 'queued':
+        return html.H6('Waiting for other simulations to finish...')
+    elif job['status'] == 'running':
+        if job['precision'] is not None:
+            # an adaptive run stops on precision rather than at a set number of trials
+            message = [html.H6('{:,} trials done, percentiles within \u00b1{:.2f}% so far...'.format(
+                job['done'], job['precision'] * 100))]
+        else:
+            message = [html.H6('{:.0f}% of {:,} trials done...'.format(job['progress'], job['n_trials']))]
+        if job['provisional'] is not None:
+            # provisional percentiles, these firm up with every batch
+            message += [html.Div('{}th percentile: {}'.format(percentile, human_format(value)))
+                        for percentile, value in job['provisional'].items()]
+        return html.Div(message)
+    elif job['status'] == 'cancelled':
+        return html.H6('Simulation cancelled - the inputs changed...')
+    return html.H6('Something went wrong, please simulate again...')
+
+
+def feedback_card(value, interest, text1, text2, monthly, prin_plus_month, income, apr, end_age, rate=0.05):
+    age_string = 'From age __'+str(end_age)+'__...this is {:g}% of the total value...'.format(rate * 100)
     width = 4
     div = html.Div([
                     dbc.Row(
@@ -329,16 +436,3 @@ def calc_avg_apr(yearly_totals):
             apr = (factor - 1) * 100
             yearly_apr.append(apr)
     return np.mean(yearly_apr)
-
-def get_apr(payment_coeffs):
-    roots = np.roots(payment_coeffs)
-    real_roots = roots.real[abs(roots.imag) < 1e-5]
-    closest_to_one = min(real_roots, key=lambda x: abs(x - 1))
-    return (closest_to_one - 1) * 100
-    # real_roots.sort()
-    # # return the answer which is larger but closest to 1
-    # for root in real_roots:
-    #     if root < 1:
-    #         continue
-    #     else:
-    #         return
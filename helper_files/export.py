@@ -0,0 +1,138 @@
+import io
+import json
+
+import numpy as np
+
+try:
+    import pyarrow
+    import pyarrow.parquet as pq
+except ImportError:
+    # parquet exports need pyarrow, the .npy ones don't
+    pyarrow = None
+
+from helper_files.financial_calcs import TIMESTEPS, get_batch_apr, simulate_block_paths
+from helper_files.simulation import RESULT_VERSION, get_n_blocks, split_options
+
+# a cached run is exported by simulating its trials again from its seed, a block at a time, so an export only ever
+# holds one block of trials in memory however many there are
+# GET /export/<key>/manifest.json - the inputs, seed and the shape of every array
+# GET /export/<key>/totals.npy, aprs.npy or paths.npy - the final totals, annualised returns and trials x years totals
+# GET /export/<key>/trials.parquet - a row per trial with its total and return, ?paths=1 adds a column per age
+ARRAYS = ['totals', 'aprs', 'paths']
+MODEL_FIELDS = ['principal', 'strat_ages', 'monthly', 'bond_vals', 'stock_gain', 'stock_sd', 'bond_gain', 'bond_sd']
+ASSET_MODEL_FIELDS = ['principal', 'strat_ages', 'monthly', 'weights', 'means', 'cov']
+
+
+def is_exportable(sim):
+    # runs cached before exports were added don't know their model
+    return sim.get('model') is not None
+
+
+def get_manifest(sim, key):
+    model = sim['model']
+    strat_ages = model[1]
+    return {'key': key,
+            'result_version': RESULT_VERSION,
+            'seed': sim['seed'],
+            'n_trials': sim['n_simulated'],
+            'options': sim['options'],
+            'model': dict(zip(MODEL_FIELDS if len(model) == 8 else ASSET_MODEL_FIELDS, to_json(model))),
+            'total_paid_in': sim['total_paid_in'],
+            # the columns of paths, from the principal at the first age to the final total at the end age
+            'ages': list(range(strat_ages[0], strat_ages[-1] + 1)),
+            'arrays': {name: {'shape': list(get_shape(sim, name)), 'dtype': '<f8'} for name in ARRAYS}}
+
+
+def get_shape(sim, name):
+    strat_ages = sim['model'][1]
+    if name == 'paths':
+        return sim['n_simulated'], strat_ages[-1] - strat_ages[0] + 1
+    return sim['n_simulated'],
+
+
+def get_npy_header(sim, name):
+    header = io.BytesIO()
+    np.lib.format.write_array_header_1_0(header, {'descr': '<f8', 'fortran_order': False,
+                                                 'shape': get_shape(sim, name)})
+    return header.getvalue()
+
+
+def get_npy_size(sim, name):
+    return len(get_npy_header(sim, name)) + int(np.prod(get_shape(sim, name))) * 8
+
+
+def iter_blocks(sim, paths=False):
+    # the final totals, annualised returns and (with paths) yearly totals of every trial, a block at a time -
+    # the same trials, in the same order, as the run itself
+    model_options = split_options(sim['options'])[0]
+    steps_per_year = TIMESTEPS[model_options.get('timestep', 'yearly')]
+    n_trials = sim['n_simulated']
+    for block in range(get_n_blocks(n_trials)):
+        step_totals, total_paid_in, payment_coeffs = simulate_block_paths(sim['seed'], block, n_trials, sim['model'],
+                                                                          **model_options)
+        totals = step_totals[:, -1]
+        aprs = get_batch_apr(payment_coeffs, totals, steps_per_year=steps_per_year)
+        yield totals, aprs, step_totals[:, ::steps_per_year] if paths else None
+
+
+def stream_npy(sim, name):
+    # a .npy file written as it's simulated, it can be memory mapped once it's saved
+    yield get_npy_header(sim, name)
+    for totals, aprs, paths in iter_blocks(sim, paths=name == 'paths'):
+        yield {'totals': totals, 'aprs': aprs, 'paths': paths}[name].astype('<f8').tobytes()
+
+
+def stream_parquet(sim, key, paths=False):
+    # a row group per block, with the manifest in the file's metadata
+    manifest = get_manifest(sim, key)
+    fields = [pyarrow.field('trial', pyarrow.int64()), pyarrow.field('total', pyarrow.float64()),
+              pyarrow.field('apr', pyarrow.float64())]
+    if paths:
+        fields += [pyarrow.field('age_{}'.format(age), pyarrow.float64()) for age in manifest['ages']]
+    schema = pyarrow.schema(fields, metadata={'manifest': json.dumps(manifest)})
+    sink = StreamBuffer()
+    writer = pq.ParquetWriter(sink, schema)
+    first_trial = 0
+    for totals, aprs, block_paths in iter_blocks(sim, paths):
+        columns = [np.arange(first_trial, first_trial + len(totals)), totals, aprs]
+        if paths:
+            columns += list(block_paths.T)
+        writer.write_table(pyarrow.Table.from_arrays(columns, schema=schema))
+        first_trial += len(totals)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+class StreamBuffer(io.RawIOBase):
+    # a write only file that gives back whatever was written to it since it was last drained
+    def __init__(self):
+        super().__init__()
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def to_json(value):
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [to_json(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
@@ -1,14 +1,24 @@
+import warnings
+
 import numpy as np
-import pandas as pd
-from scipy.stats import norm
-from sigfig import round
-import plotly.express as px
-import plotly.graph_objects as go
 
+from helper_files import history
+
+
+# trials are simulated in fixed size blocks, each with its own random stream, so a seed gives the
+# same trials however the blocks are split up
+BLOCK_SIZE = 2048
+# the random stream of a block's drawdown years, apart from the stream of its trials
+DRAWDOWN_STREAM = 1
+# the number of steps each year of a simulation is split into
+TIMESTEPS = {'yearly': 1, 'monthly': 12}
+
+TABLE_COLUMNS = ['Age', 'Monthly', 'Bond %', 'Bond Change', 'Stock %', 'Stock Change', 'Bond Value', 'Bond Int',
+                 'Stock Value', 'Stock Int', 'Total Value', 'Total Int']
 
 
 class Calculator:
-    def __init__(self, principal, ages, monthly, bond_prop, stock_exp, stock_sd, bond_exp, bond_sd):
+    def __init__(self, principal, ages, monthly, bond_prop, stock_exp, stock_sd, bond_exp, bond_sd, seed=None):
         self.principal = principal
         self.ages = ages
         self.monthly = monthly
@@ -17,44 +27,43 @@ class Calculator:
         self.stock_sd = stock_sd
         self.bond_exp = bond_exp
         self.bond_sd = bond_sd
+        self.seed = new_seed() if seed is None else seed
 
         self.bond_changes, self.stock_changes = self.create_yearly_market_change()
         self.number_of_phases = len(ages) - 1
 
-        self.phases = self.get_phase_data()
-
-        self.df = self.concat_phase_dfs()
-
-
-    def get_last_phase(self):
-        return self.phases[-1]
+        self.columns = self.calc_columns()
+        self.df = None
 
     def get_df(self):
+        # the dataframe is only built if someone asks for it
+        if self.df is None:
+            # pandas is slow to import and only needed here
+            import pandas as pd
+            self.df = pd.DataFrame(self.columns, columns=TABLE_COLUMNS)
         return self.df
 
-    def concat_phase_dfs(self):
-        df_list = []
-        for i, phase in enumerate(self.phases):
-            df_list.append(phase.get_phase_df())
-        concat_df = pd.concat(df_list)
-        concat_df.reset_index(drop=True, inplace=True)
-        return concat_df
+    def get_records(self):
+        rows = zip(*[self.columns[name].tolist() for name in TABLE_COLUMNS])
+        return [dict(zip(TABLE_COLUMNS, row)) for row in rows]
+
+    def get_last_total(self):
+        return self.columns['Total Value'][-1]
 
     def create_yearly_market_change(self):
         # n years of change...
         n = self.ages[-1] - self.ages[0]
 
         # genertae the bond/stock changes for each year
+        rng = np.random.default_rng(self.seed)
         if self.bond_sd != 0:
-            bond_changes = list(np.random.normal(self.bond_exp, self.bond_sd, n))
-            bond_changes = [round_dp(float(num), 2) for num in bond_changes]
+            bond_changes = np.round(rng.normal(self.bond_exp, self.bond_sd, n), 2)
         else:
-            bond_changes = [self.bond_exp] * n
-        if self.bond_sd != 0:
-            stock_changes = list(np.random.normal(self.stock_exp, self.stock_sd, n))
-            stock_changes = [round_dp(float(num), 2) for num in stock_changes]
+            bond_changes = np.full(n, float(self.bond_exp))
+        if self.stock_sd != 0:
+            stock_changes = np.round(rng.normal(self.stock_exp, self.stock_sd, n), 2)
         else:
-            stock_changes = [self.stock_exp] * n
+            stock_changes = np.full(n, float(self.stock_exp))
 
         return bond_changes, stock_changes
 
@@ -73,106 +82,56 @@ class Calculator:
     def get_number_of_phases(self):
         return self.number_of_phases
 
-    def get_phase_data(self):
-        phases = []
-        for i in range(self.get_number_of_phases()):
-            new_phase = Phase(self.ages[i], self.ages[i + 1],
-                              self.principal if i == 0 else phases[-1].get_last_total(), self.monthly[i],
-                              self.bond_prop[i], self.bond_changes[self.ages[i] - self.ages[0]: self.ages[i + 1] -
-                                                                                                self.ages[0]],
-                              self.stock_changes[self.ages[i] - self.ages[0]: self.ages[i + 1] - self.ages[0]])
-            phases.append(new_phase)
-        return phases
-
-
-class Phase:
-    def __init__(self, start_age, end_age, initial_val, monthly, bond_prop, bond_changes, stock_changes):
-        self.start_age = start_age
-        self.end_age = end_age
-        self.length_of_phase = self.end_age - self.start_age
-        self.initial_val = initial_val
-        self.monthly = monthly
-        self.bond_prop = bond_prop
-        self.bond_changes = bond_changes
-        self.stock_changes = stock_changes
-
-        self.bond_values = self.calc_phase_data(self.bond_prop, self.bond_changes)
-        self.stock_values = self.calc_phase_data(100 - self.bond_prop, self.stock_changes)
-        # self.totals = [[sum(i[0]), sum(i[1])] for i in zip(*[self.bond_values, self.stock_values])]
-        self.totals = self.make_total_list()
-
-        self.first_bond_value = self.bond_values[0][1]
-        self.first_stock_value = self.stock_values[0][1]
-        self.first_total_value = self.totals[0][1]
-
-        self.last_bond_value = self.bond_values[-1][1]
-        self.last_stock_value = self.stock_values[-1][1]
-        self.last_total_value = self.totals[-1][1]
-
-        self.last_bond_interest = self.bond_values[-1][0]
-        self.last_stock_interest = self.stock_values[-1][0]
-        self.last_total_interest = self.totals[-1][0]
-
-        self.phase_df = self.make_df()
-
-    def get_last_total(self):
-        return self.last_total_value
-
-    def make_df(self):
-        all_years = []
-        for i in range(self.end_age - self.start_age):
-            year_row = [self.start_age + i, self.monthly, self.bond_prop, self.bond_changes[i], 100 - self.bond_prop,
-                        self.stock_changes[i], self.bond_values[i][1], self.bond_values[i][0], self.stock_values[i][1],
-                        self.stock_values[i][0],  self.totals[i][1], self.totals[i][0]]
-            all_years.append(year_row)
-        df = pd.DataFrame(all_years, columns=['Age', 'Monthly', 'Bond %', 'Bond Change', 'Stock %', 'Stock Change',
-                                              'Bond Value', 'Bond Int', 'Stock Value', 'Stock Int', 'Total Value',
-                                              'Total Int'])
-        return df
-
-    def get_phase_df(self):
-        return self.phase_df
-
-    def make_total_list(self):
-        totals = []
-        for i, values in enumerate(zip(self.bond_values, self.stock_values)):
-            interest = values[0][0] + values[1][0]
-            value = values[0][1] + values[1][1]
-            totals.append([round(interest, decimals=2), round(value, decimals=2)])
-        return totals
-
-    def calc_phase_data(self, prop, instrument_change):
-        year_cont = self.monthly * 12 * prop / 100
-        first_value = self.initial_val * prop / 100
-        end_year_values = []
-        for i in range(self.length_of_phase):
-            previous_value = end_year_values[-1][1] + year_cont if i != 0 else first_value + year_cont
-            # yearly interest .... increased value
-            this_year_values = [round(float(previous_value * instrument_change[i] / 100), decimals=2),
-                                round(float(previous_value * (1 + instrument_change[i] / 100)), decimals=2)]
-            end_year_values.append(this_year_values)
-        return end_year_values
-
-    def get_daily_interest_rate(self, value, prop, bond_rate, stock_rate):
-        return value * prop * bond_rate / 100 + value * (100 - prop) * stock_rate / 100
-
-    def get_bond_values(self):
-        return self.bond_values
-
-    def get_stock_values(self):
-        return self.stock_values
-
-    def get_totals(self):
-        return self.totals
-
-    def get_last_bond_value(self):
-        return self.last_bond_value
-
-    def get_last_stock_value(self):
-        return self.last_stock_value
-
-    def get_last_total(self):
-        return self.last_total_value
+    def calc_columns(self):
+        # every column of the table for every year, filled in a single pass over the years
+        phase_lengths = np.diff(self.ages)
+        n = int(phase_lengths.sum())
+        monthly = np.repeat(np.asarray(self.monthly[:self.number_of_phases], dtype=float), phase_lengths)
+        bond_prop = np.repeat(np.asarray(self.bond_prop[:self.number_of_phases]), phase_lengths)
+        phase_of_year = np.repeat(np.arange(self.number_of_phases), phase_lengths)
+        phase_starts = np.r_[True, np.diff(phase_of_year) != 0]
+
+        bond_growth = 1 + self.bond_changes / 100
+        stock_growth = 1 + self.stock_changes / 100
+        bond_conts = monthly * 12 * bond_prop / 100
+        stock_conts = monthly * 12 * (100 - bond_prop) / 100
+
+        # value held in each asset during each year (after that year's contribution)
+        bond_held = np.empty(n)
+        stock_held = np.empty(n)
+        bond_value = stock_value = 0.0
+        for year in range(n):
+            if phase_starts[year]:
+                # the whole portfolio is rebalanced at the start of each phase
+                total = self.principal if year == 0 else bond_value + stock_value
+                bond_value = total * bond_prop[year] / 100
+                stock_value = total * (100 - bond_prop[year]) / 100
+            bond_held[year] = bond_value + bond_conts[year]
+            stock_held[year] = stock_value + stock_conts[year]
+            bond_value = bond_held[year] * bond_growth[year]
+            stock_value = stock_held[year] * stock_growth[year]
+
+        bond_values = bond_held * bond_growth
+        stock_values = stock_held * stock_growth
+        bond_int = bond_held * self.bond_changes / 100
+        stock_int = stock_held * self.stock_changes / 100
+
+        # round once, at the end, for display
+        columns = {
+            'Age': self.ages[0] + np.arange(n),
+            'Monthly': monthly,
+            'Bond %': bond_prop,
+            'Bond Change': self.bond_changes,
+            'Stock %': 100 - bond_prop,
+            'Stock Change': self.stock_changes,
+            'Bond Value': np.round(bond_values, 2),
+            'Bond Int': np.round(bond_int, 2),
+            'Stock Value': np.round(stock_values, 2),
+            'Stock Int': np.round(stock_int, 2),
+            'Total Value': np.round(bond_values + stock_values, 2),
+            'Total Int': np.round(bond_int + stock_int, 2),
+        }
+        return columns
 
 
 def get_table_conditions():
@@ -200,14 +159,18 @@ def get_table_conditions():
     ]
     return conditions
 
-def simple_calc(principal, strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd):
+
+# the same for every table, built once (in the gunicorn master when preloading)
+TABLE_CONDITIONS = get_table_conditions()
+
+def simple_calc(principal, strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd, seed=None):
     yearly_totals = [principal]
     payment_coeffs = []
     number_of_phases = len(strat_ages) - 1
     total_paid_in = 0
     year = 0
     bond_changes, stock_changes = create_yearly_market_change(strat_ages[0], strat_ages[-1], bond_gain, bond_sd,
-                                                              stock_gain, stock_sd)
+                                                              stock_gain, stock_sd, np.random.default_rng(seed))
     for i in range(number_of_phases):
         for j in range(strat_ages[i] - strat_ages[0], strat_ages[i + 1] - strat_ages[0]):
             # this represents each year
@@ -222,94 +185,415 @@ def simple_calc(principal, strat_ages, monthly, bond_vals, stock_gain, stock_sd,
     return yearly_totals, total_paid_in, payment_coeffs
 
 
-def create_yearly_market_change(start_age, end_age, bond_exp, bond_sd, stock_exp, stock_sd):
+def simulate_blocks(seed, first_block, n_blocks, n_trials, model, sampling='iid', timestep='yearly',
+                    returns='normal'):
+    # final totals of the trials in blocks first_block...first_block + n_blocks of an n_trials run
+    # model is either the bond/stock model or an asset model, see get_asset_model
+    start = first_block * BLOCK_SIZE
+    end = min(n_trials, (first_block + n_blocks) * BLOCK_SIZE)
+    final_totals = np.empty(end - start)
+    for block in range(first_block, first_block + n_blocks):
+        block_start = block * BLOCK_SIZE
+        block_end = min(n_trials, block_start + BLOCK_SIZE)
+        yearly_totals, total_paid_in, payment_coeffs = simulate_block_paths(seed, block, n_trials, model, sampling,
+                                                                            timestep, returns)
+        final_totals[block_start - start:block_end - start] = yearly_totals[:, -1]
+    return final_totals, total_paid_in, payment_coeffs
+
+
+def simulate_block_paths(seed, block, n_trials, model, sampling='iid', timestep='yearly', returns='normal'):
+    # every step's total for the trials in one block of an n_trials run, see asset_calc
+    principal, strat_ages, monthly, weights, means, cov = get_asset_model(model)
+    block_start = block * BLOCK_SIZE
+    block_end = min(n_trials, block_start + BLOCK_SIZE)
+    return asset_calc(block_end - block_start, principal, strat_ages, monthly, weights, means, cov,
+                      get_block_rng(seed, block), sampling, timestep, returns)
+
+
+def simulate_scenario_blocks(seed, first_block, n_blocks, n_trials, models, sampling='iid', timestep='yearly',
+                             returns='normal'):
+    # simulate_blocks for several models at once - final totals are scenarios x trials
+    # every model gets the same draws simulate_blocks would give it, then they all go through the years together
+    # with shorter horizons padded at the front by years that leave the total alone
+    models = [get_asset_model(model) for model in models]
+    strategies = [get_yearly_strategy(*model[1:4], timestep) for model in models]
+    lengths = np.array([len(yearly_conts) for yearly_conts, yearly_weights in strategies])
+    n_years = lengths.max()
+    yearly_conts = np.zeros((len(models), n_years))
+    for i, (conts, weights) in enumerate(strategies):
+        yearly_conts[i, n_years - lengths[i]:] = conts
+    principals = np.array([model[0] for model in models], dtype=float)
+    payment_coeffs = yearly_conts.copy()
+    payment_coeffs[np.arange(len(models)), n_years - lengths] += principals
+
+    start = first_block * BLOCK_SIZE
+    end = min(n_trials, (first_block + n_blocks) * BLOCK_SIZE)
+    final_totals = np.empty((len(models), end - start))
+    for block in range(first_block, first_block + n_blocks):
+        block_start = block * BLOCK_SIZE
+        block_end = min(n_trials, block_start + BLOCK_SIZE)
+        growth = np.ones((len(models), block_end - block_start, n_years))
+        # models with the same horizon and market assumptions share their draws (common random numbers),
+        # so they are only drawn once
+        draws = {}
+        for i, (principal, strat_ages, monthly, weights, means, cov) in enumerate(models):
+            market = (strat_ages[-1] - strat_ages[0], tuple(means), tuple(map(tuple, cov)))
+            if market not in draws:
+                draws[market] = get_asset_growth(block_end - block_start, strat_ages[-1] - strat_ages[0], means, cov,
+                                                 get_block_rng(seed, block), sampling, timestep, returns)
+            growth[i, :, n_years - lengths[i]:] = get_portfolio_growth(strategies[i][1], draws[market])
+
+        totals = np.repeat(principals[:, None], block_end - block_start, axis=1)
+        for year in range(n_years):
+            totals = (totals + yearly_conts[:, year, None]) * growth[:, :, year]
+        final_totals[:, block_start - start:block_end - start] = totals
+    return final_totals, yearly_conts.sum(axis=1), payment_coeffs
+
+
+def simulate_drawdown_blocks(seed, first_block, n_blocks, n_trials, model, rate, n_years, sampling='iid',
+                             timestep='yearly', returns='normal'):
+    # how many years the money lasts when rate (e.g. 0.05) of the final total is withdrawn every year for n_years,
+    # held in the last strategy row's mix - inf where it lasts them all
+    # with the withdrawals a fixed share of the final total, when the money runs out doesn't depend on how much
+    # there was, so each block draws its own years after end_age rather than carrying on from its trials
+    principal, strat_ages, monthly, weights, means, cov = get_asset_model(model)
+    steps = TIMESTEPS[timestep]
+    step_weights = np.tile(np.array(weights[-1], dtype=float), (n_years * steps, 1))
+    start = first_block * BLOCK_SIZE
+    end = min(n_trials, (first_block + n_blocks) * BLOCK_SIZE)
+    depleted = np.empty(end - start)
+    for block in range(first_block, first_block + n_blocks):
+        block_start = block * BLOCK_SIZE
+        block_end = min(n_trials, block_start + BLOCK_SIZE)
+        growth = get_portfolio_growth(step_weights, get_asset_growth(block_end - block_start, n_years, means, cov,
+                                                                     get_block_rng(seed, block, DRAWDOWN_STREAM),
+                                                                     sampling, timestep, returns))
+        depleted[block_start - start:block_end - start] = get_depletion_steps(growth, rate / steps) / steps
+    return depleted
+
+
+def get_depletion_steps(growth, withdrawal):
+    # the step each trial's balance, starting at 1, first can't cover the withdrawal (inf if never)
+    # paths that run out are frozen at zero by the mask rather than branched on
+    balance = np.ones(len(growth))
+    depleted = np.full(len(growth), np.inf)
+    running = np.ones(len(growth), dtype=bool)
+    for step in range(growth.shape[1]):
+        balance -= withdrawal
+        ran_out = running & (balance < 0)
+        depleted[ran_out] = step
+        running &= ~ran_out
+        balance = np.where(running, balance * growth[:, step], 0)
+    return depleted
+
+
+def get_asset_model(model):
+    # an asset model is (principal, strat_ages, monthly, weights, means, cov) for any number of assets, with
+    # weights a row of fractions per phase, the yearly gains in % and their covariance in %^2
+    # the bond/stock model (principal, strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd)
+    # is its two asset case, bonds then stocks, uncorrelated
+    if len(model) == 6:
+        return model
+    principal, strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd = model
+    weights = [[bonds / 100, 1 - bonds / 100] for bonds in bond_vals]
+    return principal, strat_ages, monthly, weights, [bond_gain, stock_gain], [[bond_sd ** 2, 0], [0, stock_sd ** 2]]
+
+
+def new_seed():
+    return int(np.random.SeedSequence().generate_state(1)[0])
+
+
+def get_block_rng(seed, block, stream=None):
+    # each block gets an independent child stream that only depends on the seed and the block number
+    # (and the stream, for draws that mustn't overlap the trials')
+    spawn_key = (block,) if stream is None else (block, stream)
+    return np.random.default_rng(np.random.SeedSequence(seed, spawn_key=spawn_key))
+
+
+def asset_calc(n_trials, principal, strat_ages, monthly, weights, means, cov, rng=None, sampling='iid',
+               timestep='yearly', returns='normal'):
+    # every trial of an asset model at once - rows are trials, columns are years
+    # (or months with monthly steps, where the monthly amount goes in and the portfolio is rebalanced every month)
+    yearly_conts, yearly_weights = get_yearly_strategy(strat_ages, monthly, weights, timestep)
+    n_years = len(yearly_conts)
+    growth = get_portfolio_growth(yearly_weights, get_asset_growth(n_trials, strat_ages[-1] - strat_ages[0], means,
+                                                                   cov, rng, sampling, timestep, returns))
+
+    # the only loop left is the cumulative pass over the years
+    yearly_totals = np.empty((n_trials, n_years + 1))
+    yearly_totals[:, 0] = principal
+    for year in range(n_years):
+        yearly_totals[:, year + 1] = (yearly_totals[:, year] + yearly_conts[year]) * growth[:, year]
+
+    payment_coeffs = yearly_conts.copy()
+    payment_coeffs[0] += principal
+    return yearly_totals, yearly_conts.sum(), payment_coeffs
+
+
+def get_batch_apr(payment_coeffs, final_totals, tol=1e-10, max_iter=100, steps_per_year=1):
+    # annualised return for every trial - solves sum(coeff * x^(n - k)) = final for the growth factor x
+    # payment_coeffs is either one row of yearly payments shared by all trials or a row per trial (or scenario),
+    # with monthly payments x is the monthly growth and steps_per_year is 12
+    # e.g. a row per scenario as scenarios x 1 x years against scenarios x trials totals - the rows are only ever
+    # broadcast against the trials, never copied out for each of them
+    final_totals = np.asarray(final_totals, dtype=float)
+    payment_coeffs = np.asarray(payment_coeffs, dtype=float)
+    total_paid = np.broadcast_to(payment_coeffs.sum(axis=-1), final_totals.shape)
+    columns = [payment_coeffs[k] if payment_coeffs.ndim == 1 else
+               np.broadcast_to(payment_coeffs[..., k], final_totals.shape) for k in range(payment_coeffs.shape[-1])]
+    valid = (final_totals > 0) & (total_paid > 0)
+
+    # f(0) = -final < 0 and, for x >= 1, f(x) >= total_paid * x - final so the root is bracketed
+    lo = np.zeros_like(final_totals)
+    hi = np.where(valid, np.maximum(1, final_totals / np.where(valid, total_paid, 1)), 1)
+    x = np.clip(np.ones_like(final_totals), lo, hi)
+    # trials stop moving once they converge so each answer doesn't depend on the rest of the batch,
+    # and only the ones still moving are worked on
+    done = ~valid
+
+    for i in range(max_iter):
+        active = np.nonzero(~done)
+        if len(active[0]) == 0:
+            break
+        x_active, lo_active, hi_active = x[active], lo[active], hi[active]
+
+        # horner's method for the polynomial and its derivative - far from the root these can overflow, which
+        # only sends that step to bisection
+        value = np.zeros_like(x_active)
+        slope = np.zeros_like(x_active)
+        with np.errstate(over='ignore', invalid='ignore'):
+            for column in columns:
+                slope = slope * x_active + value
+                value = value * x_active + (column if payment_coeffs.ndim == 1 else column[active])
+            slope = slope * x_active + value
+            value = value * x_active - final_totals[active]
+
+        lo[active] = np.where(value < 0, x_active, lo_active)
+        hi[active] = np.where(value > 0, x_active, hi_active)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            newton = x_active - value / slope
+        # fall back to bisection whenever newton leaves the bracket
+        bisect = ~((newton > lo[active]) & (newton < hi[active]))
+        new_x = np.where(bisect, (lo[active] + hi[active]) / 2, newton)
+        done[active] = np.abs(new_x - x_active) <= tol * np.maximum(1, x_active)
+        x[active] = new_x
+
+    return np.where(valid, (x ** steps_per_year - 1) * 100, np.nan)
+
+
+def get_yearly_strategy(strat_ages, monthly, weights, timestep='yearly'):
+    # expand the strategy rows into a yearly contribution and asset weights (years x assets) for each year (or month)
+    steps = TIMESTEPS[timestep]
+    yearly_conts = []
+    yearly_weights = []
+    for i in range(len(strat_ages) - 1):
+        phase_length = strat_ages[i + 1] - strat_ages[i]
+        if phase_length <= 0:
+            continue
+        yearly_conts += [monthly[i] * 12 / steps] * phase_length * steps
+        yearly_weights += [weights[i]] * phase_length * steps
+    return np.array(yearly_conts, dtype=float), np.array(yearly_weights, dtype=float)
+
+
+def get_portfolio_growth(yearly_weights, asset_growth):
+    # the growth of a portfolio rebalanced to the weights every step, trials x steps
+    return (yearly_weights.T[:, None, :] * asset_growth).sum(axis=0)
+
+
+def get_asset_growth(n_trials, n_years, means, cov, rng=None, sampling='iid', timestep='yearly', returns='normal'):
+    # the growth factor of every asset over every year (or month) of every trial - assets x trials x steps
+    # correlated draws are independent normals through the cholesky factor of the correlations, scaled by the sds
+    if returns == 'bootstrap':
+        # blocks of historical years in place of the means and covariance
+        if sampling != 'iid':
+            raise ValueError('Historical returns can only be sampled at random')
+        rng = np.random.default_rng() if rng is None else rng
+        return history.sample_growth(n_trials, n_years, len(means), rng, TIMESTEPS[timestep])
+    elif returns != 'normal':
+        raise ValueError('Unknown return model: ' + str(returns))
+    means = np.asarray(means, dtype=float)
+    cov = np.asarray(cov, dtype=float)
+    n_assets = len(means)
+    n = n_years * TIMESTEPS[timestep]
+    sds = np.sqrt(np.diag(cov))
+    if timestep == 'yearly':
+        locs, scales, corr = means, sds, get_correlation(cov, sds)
+    else:
+        locs, scales, corr = get_monthly_lognormal(means, sds, get_correlation(cov, sds))
+    factor = scales[:, None] * get_cholesky(corr)
+    rng = np.random.default_rng() if rng is None else rng
+
+    if sampling == 'iid':
+        # assets that don't move don't take any draws
+        moving = scales != 0
+        changes = np.tensordot(factor[:, moving], rng.standard_normal((moving.sum(), n_trials, n)), axes=1)
+    else:
+        normals = get_standard_normals(n_trials, n_assets * n, rng, sampling).reshape(n_trials, n_assets, n)
+        changes = np.tensordot(factor, normals.transpose(1, 0, 2), axes=1)
+    changes = locs[:, None, None] + changes
+    if timestep == 'yearly':
+        return 1 + changes / 100
+    return np.exp(changes)
+
+
+def get_correlation(cov, sds):
+    # assets that don't move are uncorrelated with everything
+    scale = np.outer(sds, sds)
+    corr = np.divide(cov, scale, out=np.zeros_like(cov), where=scale > 0)
+    np.fill_diagonal(corr, 1)
+    return corr
+
+
+def get_cholesky(corr):
+    try:
+        return np.linalg.cholesky(corr)
+    except np.linalg.LinAlgError:
+        raise ValueError('The covariance matrix must be positive definite')
+
+
+def get_monthly_lognormal(means, sds, corr):
+    # mean, sd and correlations of lognormal monthly log returns, twelve months of which compound to the yearly
+    # means and covariance
+    if np.any(means <= -100):
+        raise ValueError('Monthly steps need a yearly gain above -100%')
+    relative_sds = sds / (100 + means)
+    log_cov = np.log(1 + corr * np.outer(relative_sds, relative_sds))
+    variance = np.diag(log_cov)
+    mean = np.log(1 + means / 100) - variance / 2
+    return mean / 12, np.sqrt(variance / 12), get_correlation(log_cov, np.sqrt(variance))
+
+
+def get_standard_normals(n_trials, dims, rng, sampling):
+    if sampling == 'antithetic':
+        # every draw is paired with its mirror image
+        half = rng.standard_normal((-(-n_trials // 2), dims))
+        return np.concatenate([half, -half])[:n_trials]
+    elif sampling == 'sobol':
+        # scrambled sobol points pushed through the inverse normal cdf
+        # scipy is slow to import so it's left until sobol sampling is first used
+        from scipy.special import ndtri
+        from scipy.stats import qmc
+        sobol = qmc.Sobol(d=dims, scramble=True, seed=rng)
+        with warnings.catch_warnings():
+            # sobol points are best taken in powers of 2, the last block of a run might not be
+            warnings.simplefilter('ignore', UserWarning)
+            points = sobol.random(n_trials)
+        return ndtri(np.clip(points, 1e-12, 1 - 1e-12))
+    raise ValueError('Unknown sampling scheme: ' + str(sampling))
+
+
+def create_yearly_market_change(start_age, end_age, bond_exp, bond_sd, stock_exp, stock_sd, rng=None):
     # n years of change...
     n = end_age - start_age
+    rng = np.random.default_rng() if rng is None else rng
 
     # genertae the bond/stock changes for each year
     if bond_sd != 0:
-        bond_changes = list(np.random.normal(bond_exp, bond_sd, n))
+        bond_changes = list(rng.normal(bond_exp, bond_sd, n))
     else:
         bond_changes = [bond_exp] * n
     if stock_sd != 0:
-        stock_changes = list(np.random.normal(stock_exp, stock_sd, n))
+        stock_changes = list(rng.normal(stock_exp, stock_sd, n))
     else:
         stock_changes = [stock_exp] * n
 
     return bond_changes, stock_changes
 
 colour = 'blue'
-def make_histo(totals_list, totals_df, n_times):
-
-    bins = np.histogram_bin_edges(totals_list, bins=20)
-
-    # create the bins
-    counts, bins = np.histogram(totals_df, bins=bins)
-
-    hist_trace = go.Bar(x=bins,
-                        y=counts,
-                        opacity=0.75,
-                        name='',
-                        marker={
-                           'line': {
-                               'width': 0.8,
-                               'color': 'black'},
-                           'color': colour
-                       })
-
-    hist_layout = go.Layout(
-        xaxis={
-            'type': 'linear',
-            'linewidth': 3,
-            'showline': True,
-            'linecolor': colour,
-            'title': 'Portfolio value ($)',
-            'automargin': True,
-            'gridcolor': 'whitesmoke',
-        },
-        bargap=0,
-        plot_bgcolor='rgb(255,255,255)',
-        yaxis={
-            'title': '',
+# the figures are built as plain dicts from a handful of numbers, whatever the number of trials
+AXIS_LAYOUT = {
+    'type': 'linear',
+    'linewidth': 3,
+    'showline': True,
+    'linecolor': colour,
+    'title': {'text': 'Portfolio value ($)'},
+    'automargin': True,
+    'gridcolor': 'whitesmoke',
+}
+MAX_BOX_OUTLIERS = 200
+
+
+def get_histogram(totals, trim=0.05, bins=20):
+    # bin edges and counts over the totals, leaving out the top and bottom trim of them
+    # totals is an ExactQuantiles or QuantileSketch of the final totals
+    edges = np.histogram_bin_edges([], bins=bins, range=tuple(totals.percentiles([trim * 100, 100 - trim * 100])))
+    return edges, totals.histogram(edges)
+
+
+def make_histo(totals, trim=0.05, bins=20):
+    edges, counts = get_histogram(totals, trim, bins)
+
+    hist_trace = {'type': 'bar',
+                  'x': ((edges[:-1] + edges[1:]) / 2).tolist(),
+                  'y': counts.tolist(),
+                  'width': np.diff(edges).tolist(),
+                  'opacity': 0.75,
+                  'name': '',
+                  'marker': {
+                      'line': {
+                          'width': 0.8,
+                          'color': 'black'},
+                      'color': colour
+                  }}
+
+    hist_layout = {
+        'xaxis': AXIS_LAYOUT,
+        'bargap': 0,
+        'plot_bgcolor': 'rgb(255,255,255)',
+        'yaxis': {
+            'title': {'text': ''},
             'gridcolor': 'whitesmoke',
         },
-    )
-    hist_traces = {'data': [hist_trace], 'layout': hist_layout}
-
-    # fig = px.bar(x=bins[1:], y=counts, labels={'x': 'Portfolio value ($)', 'y': 'Frequency'})
-    # fig.update_layout(bargap=0)
-    return hist_traces
-
-def make_box(totals_list):
-    box_trace = go.Box(x=totals_list,
-                       opacity=0.75,
-                       name='',
-                       marker={
-                           'line': {
-                               'width': 0.8,
-                               'color': 'black'},
-                           'color': colour
-                       })
-
-    box_layout = go.Layout(
-        xaxis={
-            'type': 'linear',
-            'linewidth': 3,
-            'showline': True,
-            'linecolor': colour,
-            'title': 'Portfolio value ($)',
-            'automargin': True,
+    }
+    return {'data': [hist_trace], 'layout': hist_layout}
+
+
+def make_box(totals, trim=0.05):
+    # the box statistics plotly would work out in the browser, over the trimmed totals
+    lowest_val, q1, median, q3, highest_val = \
+        totals.percentiles(trim * 100 + (100 - 2 * trim * 100) * np.array([0, 0.25, 0.5, 0.75, 1]))
+    iqr = q3 - q1
+    values = totals.values()
+    trimmed = values[(values >= lowest_val) & (values <= highest_val)]
+    inside = trimmed[(trimmed >= q1 - 1.5 * iqr) & (trimmed <= q3 + 1.5 * iqr)]
+    lower_fence, upper_fence = inside.min(), inside.max()
+    outliers = np.sort(trimmed[(trimmed < lower_fence) | (trimmed > upper_fence)])
+    if len(outliers) > MAX_BOX_OUTLIERS:
+        outliers = outliers[np.linspace(0, len(outliers) - 1, MAX_BOX_OUTLIERS).astype(int)]
+
+    box_trace = {'type': 'box',
+                 'orientation': 'h',
+                 'y': [0],
+                 'q1': [float(q1)],
+                 'median': [float(median)],
+                 'q3': [float(q3)],
+                 'lowerfence': [float(lower_fence)],
+                 'upperfence': [float(upper_fence)],
+                 'opacity': 0.75,
+                 'name': '',
+                 'hoverinfo': 'x',
+                 'marker': {
+                     'line': {
+                         'width': 0.8,
+                         'color': 'black'},
+                     'color': colour
+                 }}
+    outlier_trace = {'type': 'scatter',
+                     'mode': 'markers',
+                     'x': outliers.tolist(),
+                     'y': [0] * len(outliers),
+                     'name': '',
+                     'showlegend': False,
+                     'marker': {'color': colour, 'opacity': 0.75}}
+
+    box_layout = {
+        'xaxis': AXIS_LAYOUT,
+        'plot_bgcolor': 'rgb(255,255,255)',
+        'showlegend': False,
+        'yaxis': {
+            'title': {'text': ''},
             'gridcolor': 'whitesmoke',
+            'showticklabels': False,
         },
-        plot_bgcolor='rgb(255,255,255)',
-        yaxis={
-            'title': '',
-            'gridcolor': 'whitesmoke',
-        },
-    )
-    box_traces = {'data': [box_trace], 'layout': box_layout}
-    return box_traces
-
-
-def round_dp(num, dp):
-    return round(num, decimals=dp)
\ No newline at end of file
+    }
+    return {'data': [box_trace, outlier_trace], 'layout': box_layout}
@@ -0,0 +1,81 @@
+import argparse
+import hashlib
+import os
+import sys
+
+import numpy as np
+
+# yearly returns in % as a float64 .npy file, a row per year (oldest first) and a column per asset - bonds then
+# stocks for the app. it's memory mapped so every worker shares the same pages
+# make one from a csv of year, bonds, stocks rows with `python -m helper_files.history returns.csv`
+HISTORY_FILE = os.environ.get('SIM_HISTORY_FILE', os.path.join(os.path.dirname(__file__), 'data', 'returns.npy'))
+# runs of this many consecutive years are resampled together, so good and bad spells stay together
+BLOCK_YEARS = 5
+
+_history = {}
+
+
+def get_history():
+    # the memory mapped returns and a hash of them, or None when there's no returns file
+    if HISTORY_FILE not in _history:
+        if os.path.exists(HISTORY_FILE):
+            with open(HISTORY_FILE, 'rb') as history_file:
+                version = hashlib.sha256(history_file.read()).hexdigest()
+            _history[HISTORY_FILE] = (np.load(HISTORY_FILE, mmap_mode='r'), version)
+        else:
+            _history[HISTORY_FILE] = None
+    return _history[HISTORY_FILE]
+
+
+def is_available():
+    return get_history() is not None
+
+
+def get_version():
+    # cached simulations are keyed on this so they go stale with the data
+    return get_history()[1] if is_available() else None
+
+
+def sample_growth(n_trials, n_years, n_assets, rng, steps_per_year=1):
+    # circular block bootstrap - each trial strings together blocks of consecutive years starting at random years,
+    # wrapping from the last year back to the first. growth factors are assets x trials x steps
+    if not is_available():
+        raise ValueError('There is no historical returns file at ' + HISTORY_FILE)
+    returns = get_history()[0]
+    if returns.ndim != 2 or returns.shape[1] != n_assets:
+        raise ValueError('The historical returns have {} assets, not {}'.format(
+            returns.shape[1] if returns.ndim == 2 else 1, n_assets))
+    n_history = len(returns)
+    block_years = min(BLOCK_YEARS, n_history)
+    starts = rng.integers(n_history, size=(n_trials, -(-n_years // block_years)))
+    years = (starts[:, :, None] + np.arange(block_years)).reshape(n_trials, -1)[:, :n_years] % n_history
+    growth = np.moveaxis(1 + returns[years] / 100, -1, 0)
+    if steps_per_year == 1:
+        return growth
+    # only yearly returns are known, so each year's is spread evenly over its months
+    return np.repeat(growth ** (1 / steps_per_year), steps_per_year, axis=-1)
+
+
+def convert(csv_path, output=None):
+    # a header row, then a row per year with the year first and the returns in % after it
+    rows = np.loadtxt(csv_path, delimiter=',', skiprows=1, ndmin=2)
+    rows = rows[np.argsort(rows[:, 0])]
+    if np.any(np.diff(rows[:, 0]) != 1):
+        raise ValueError('The years must be consecutive with no gaps or repeats')
+    output = output or HISTORY_FILE
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    np.save(output, np.ascontiguousarray(rows[:, 1:], dtype=np.float64))
+    return output
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description='Convert a csv of yearly returns into the historical returns file.')
+    parser.add_argument('csv', help='rows of year, bonds %%, stocks %% under a header row')
+    parser.add_argument('--output', help='where to write the .npy file, {} by default'.format(HISTORY_FILE))
+    args = parser.parse_args(args)
+    print('Wrote ' + convert(args.csv, args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
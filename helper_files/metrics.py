@@ -0,0 +1,241 @@
+import json
+import os
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+from helper_files import sim_cache
+
+try:
+    import resource
+except ImportError:
+    # no rusage (windows) - the max rss gauge is left out
+    resource = None
+
+# peak memory per request needs tracemalloc, which slows every allocation down so it's off unless asked for
+# tracemalloc is process wide, so requests running at the same time share one peak
+METRICS_MEMORY = os.environ.get('SIM_METRICS_MEMORY') == '1'
+# a json line per request is appended here
+METRICS_LOG = os.environ.get('SIM_METRICS_LOG')
+# each worker writes its histograms out this often, off the request path - a file that hasn't been written for a few
+# intervals is a dead worker's, even if its pid has been reused
+METRICS_FLUSH_INTERVAL = float(os.environ.get('SIM_METRICS_FLUSH_INTERVAL', 10))
+SECONDS_BUCKETS = [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+TRIALS_BUCKETS = [1000, 10000, 100000, 1000000, 10000000, 100000000]
+YEARS_BUCKETS = [10, 20, 40, 60, 80, 120]
+BYTES_BUCKETS = [2 ** power for power in range(20, 34, 2)]
+HELP = {'invest_sim_request_seconds': 'Time taken by each request or simulation job',
+        'invest_sim_stage_seconds': 'Time spent in each stage of a request or simulation job',
+        'invest_sim_trials': 'Trials asked for by each request or run by each job',
+        'invest_sim_years': 'Years simulated by each request or job',
+        'invest_sim_peak_memory_bytes': 'Peak traced memory during each request or job'}
+
+_local = threading.local()
+_lock = threading.Lock()
+_histograms = {}
+_log_lock = threading.Lock()
+_flusher_pid = None
+
+
+def start(kind):
+    # everything recorded on this thread until finish() belongs to this request
+    if METRICS_MEMORY:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            # python < 3.9 can only reset the peak by forgetting the traced blocks too
+            tracemalloc.clear_traces()
+    _local.record = {'kind': kind, 'start': time.perf_counter(), 'stages': {}, 'counts': {}, 'lap': None}
+
+
+def set_kind(kind):
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record['kind'] = kind
+
+
+def lap(name):
+    # ends the stage running on this thread, if any, and starts the next one
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return
+    now = time.perf_counter()
+    end_lap(record, now)
+    record['lap'] = (name, now)
+
+
+def end_lap(record, now):
+    if record['lap'] is not None:
+        name, started = record['lap']
+        add_time(record, name, now - started)
+        record['lap'] = None
+
+
+@contextmanager
+def stage(name):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record = getattr(_local, 'record', None)
+        if record is not None:
+            add_time(record, name, time.perf_counter() - started)
+
+
+def add_time(record, name, seconds):
+    record['stages'][name] = record['stages'].get(name, 0.0) + seconds
+
+
+def count(name, value):
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record['counts'][name] = value
+
+
+def finish():
+    record = getattr(_local, 'record', None)
+    if record is None:
+        return None
+    _local.record = None
+    now = time.perf_counter()
+    end_lap(record, now)
+    kind = record['kind']
+    summary = {'kind': kind, 'seconds': now - record['start'], 'stages': record['stages'],
+               'counts': record['counts'], 'pid': os.getpid(), 'time': time.time()}
+    if METRICS_MEMORY:
+        summary['peak_memory'] = tracemalloc.get_traced_memory()[1]
+
+    with _lock:
+        observe('invest_sim_request_seconds', {'kind': kind}, summary['seconds'], SECONDS_BUCKETS)
+        for name, seconds in summary['stages'].items():
+            observe('invest_sim_stage_seconds', {'kind': kind, 'stage': name}, seconds, SECONDS_BUCKETS)
+        if 'trials' in summary['counts']:
+            observe('invest_sim_trials', {'kind': kind}, summary['counts']['trials'], TRIALS_BUCKETS)
+        if 'years' in summary['counts']:
+            observe('invest_sim_years', {'kind': kind}, summary['counts']['years'], YEARS_BUCKETS)
+        if 'peak_memory' in summary:
+            observe('invest_sim_peak_memory_bytes', {'kind': kind}, summary['peak_memory'], BYTES_BUCKETS)
+    start_flusher()
+    if METRICS_LOG:
+        with _log_lock, open(METRICS_LOG, 'a') as log_file:
+            log_file.write(json.dumps(summary) + '\n')
+    return summary
+
+
+def observe(metric, labels, value, buckets):
+    key = (metric, tuple(sorted(labels.items())))
+    if key not in _histograms:
+        _histograms[key] = {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+    histogram = _histograms[key]
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            histogram['counts'][i] += 1
+    histogram['sum'] += value
+    histogram['count'] += 1
+
+
+def get_metrics_dir():
+    return os.path.join(sim_cache.CACHE_DIR, 'metrics')
+
+
+def start_flusher():
+    # started on first use so each gunicorn worker has its own thread, a thread started before the fork isn't copied
+    global _flusher_pid
+    with _lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+    threading.Thread(target=flush_every_interval, daemon=True).start()
+
+
+def flush_every_interval():
+    while True:
+        time.sleep(METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except OSError:
+            pass
+
+
+def flush():
+    # every worker keeps its own file, the /metrics route adds them all up
+    metrics_dir = get_metrics_dir()
+    sim_cache.make_cache_dir()
+    os.makedirs(metrics_dir, exist_ok=True)
+    path = os.path.join(metrics_dir, '{}.json'.format(os.getpid()))
+    with _lock:
+        rows = json.dumps([[metric, dict(labels), histogram] for (metric, labels), histogram in _histograms.items()])
+    with open(path + '.tmp', 'w') as metrics_file:
+        metrics_file.write(rows)
+    os.replace(path + '.tmp', path)
+
+
+def collect():
+    # the histograms of every live worker added together - a dead worker's file is removed, which
+    # prometheus sees as a counter reset
+    # the worker serving the scrape writes its own first, so its counts are current
+    if _histograms:
+        flush()
+    totals = {}
+    metrics_dir = get_metrics_dir()
+    names = os.listdir(metrics_dir) if os.path.isdir(metrics_dir) else []
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        path = os.path.join(metrics_dir, name)
+        try:
+            if not is_alive(int(name[:-len('.json')])) or \
+                    time.time() - os.path.getmtime(path) > 3 * METRICS_FLUSH_INTERVAL:
+                os.remove(path)
+                continue
+            with open(path) as metrics_file:
+                rows = json.load(metrics_file)
+        except (OSError, ValueError):
+            continue
+        for metric, labels, histogram in rows:
+            key = (metric, tuple(sorted(labels.items())))
+            if key not in totals:
+                totals[key] = {'buckets': histogram['buckets'], 'counts': [0] * len(histogram['buckets']),
+                               'sum': 0.0, 'count': 0}
+            total = totals[key]
+            total['counts'] = [a + b for a, b in zip(total['counts'], histogram['counts'])]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+    return totals
+
+
+def is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render():
+    # prometheus text exposition format
+    lines = []
+    totals = collect()
+    for metric in sorted({metric for metric, labels in totals}):
+        lines += ['# HELP {} {}'.format(metric, HELP[metric]), '# TYPE {} histogram'.format(metric)]
+        for (name, labels), histogram in sorted(totals.items()):
+            if name != metric:
+                continue
+            label_text = ','.join('{}="{}"'.format(key, value) for key, value in labels)
+            for bound, bucket_count in zip(histogram['buckets'] + ['+Inf'], histogram['counts'] + [histogram['count']]):
+                lines.append('{}_bucket{{{}le="{}"}} {}'.format(metric, label_text + ',' if label_text else '',
+                                                               bound, bucket_count))
+            lines.append('{}_sum{{{}}} {}'.format(metric, label_text, histogram['sum']))
+            lines.append('{}_count{{{}}} {}'.format(metric, label_text, histogram['count']))
+    if resource is not None:
+        # ru_maxrss is in kilobytes on linux
+        lines += ['# HELP invest_sim_max_rss_bytes Peak resident memory of the worker serving this scrape',
+                  '# TYPE invest_sim_max_rss_bytes gauge',
+                  'invest_sim_max_rss_bytes{{pid="{}"}} {}'.format(
+                      os.getpid(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)]
+    return '\n'.join(lines) + '\n'
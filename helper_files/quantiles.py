@@ -0,0 +1,137 @@
+import numpy as np
+
+# runs up to this size keep every value, bigger runs only keep a sketch of them
+EXACT_MAX_TRIALS = 1000000
+SKETCH_K = 1000
+# the reported rank error holds with 99% confidence
+Z_99 = 2.576
+
+
+def make_quantiles(n_trials, seed=None):
+    if n_trials <= EXACT_MAX_TRIALS:
+        return ExactQuantiles()
+    return QuantileSketch(seed=seed)
+
+
+class BlockEstimates:
+    # every full block of trials is an independent replicate (for any sampling scheme) so the spread of the
+    # per-block percentiles gives a standard error for the percentiles over the whole run
+    def __init__(self, percentiles, block_size):
+        self.percentiles = list(percentiles)
+        self.block_size = block_size
+        self.n_blocks = 0
+        self.means = np.zeros(len(self.percentiles))
+        self.squares = np.zeros(len(self.percentiles))
+
+    def update(self, values):
+        n_full = len(values) // self.block_size
+        if n_full == 0:
+            return
+        blocks = np.asarray(values[:n_full * self.block_size]).reshape(n_full, self.block_size)
+        estimates = np.percentile(blocks, self.percentiles, axis=1)
+        # merge the running mean and sum of squared deviations with this batch's
+        means = estimates.mean(axis=1)
+        delta = means - self.means
+        n_blocks = self.n_blocks + n_full
+        self.means += delta * n_full / n_blocks
+        self.squares += ((estimates - means[:, None]) ** 2).sum(axis=1) + delta ** 2 * self.n_blocks * n_full / n_blocks
+        self.n_blocks = n_blocks
+
+    def standard_errors(self):
+        if self.n_blocks < 2:
+            return dict.fromkeys(self.percentiles, np.nan)
+        variance = self.squares / (self.n_blocks - 1)
+        return dict(zip(self.percentiles, np.sqrt(variance / self.n_blocks).tolist()))
+
+
+class ExactQuantiles:
+    def __init__(self):
+        self.chunks = []
+        self.count = 0
+        self.rank_error = 0.0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        self.chunks.append(values)
+        self.count += len(values)
+
+    def values(self):
+        if len(self.chunks) != 1:
+            self.chunks = [np.concatenate(self.chunks) if self.chunks else np.empty(0)]
+        return self.chunks[0]
+
+    def percentiles(self, percentiles):
+        # np.percentile finds every requested rank in one partition of the values
+        # nan when every value was nan, e.g. the returns of trials that never paid anything in
+        if self.count == 0:
+            return np.full(np.shape(percentiles), np.nan)
+        return np.percentile(self.values(), percentiles)
+
+    def histogram(self, edges):
+        return np.histogram(self.values(), bins=edges)[0]
+
+
+class QuantileSketch:
+    # a KLL sketch - a stack of compactors where level h holds items standing in for 2^h values each,
+    # memory is a few times k whatever the number of values
+    def __init__(self, k=SKETCH_K, seed=None):
+        self.k = k
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self.rng = np.random.default_rng(seed)
+        # variance of the rank error added by the compactions
+        self.variance = 0.0
+
+    @property
+    def rank_error(self):
+        # as a fraction of the number of values
+        return Z_99 * np.sqrt(self.variance) / self.count if self.count else 0.0
+
+    def capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(2, int(np.ceil(self.k * (2 / 3) ** depth)))
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        self.count += len(values)
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+
+    def compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if len(items) > self.capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                items = np.sort(items)
+                # an odd item out stays where it is, every other item of the rest moves up a level
+                odd = len(items) % 2
+                promoted = items[odd + self.rng.integers(2)::2]
+                self.levels[level] = items[:odd]
+                self.levels[level + 1] = np.concatenate([self.levels[level + 1], promoted])
+                self.variance += 4.0 ** level
+            level += 1
+
+    def values(self):
+        return np.concatenate(self.levels)
+
+    def weighted_items(self):
+        values = self.values()
+        weights = np.concatenate([np.full(len(items), 2.0 ** level) for level, items in enumerate(self.levels)])
+        order = np.argsort(values)
+        return values[order], weights[order]
+
+    def percentiles(self, percentiles):
+        if self.count == 0:
+            return np.full(np.shape(percentiles), np.nan)
+        values, weights = self.weighted_items()
+        ranks = np.cumsum(weights)
+        index = np.searchsorted(ranks, np.asarray(percentiles) / 100 * ranks[-1])
+        return values[np.minimum(index, len(values) - 1)]
+
+    def histogram(self, edges):
+        values, weights = self.weighted_items()
+        return np.histogram(values, bins=edges, weights=weights)[0]
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # no file locks (windows) - single flight only works inside one process
+    fcntl = None
+
+# shared by every gunicorn worker on the machine, and private to the user they run as - results are pickled, so
+# anyone who could write an entry could run code in the app
+CACHE_DIR = os.environ.get('SIM_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'invest_sim'))
+CACHE_TTL = float(os.environ.get('SIM_CACHE_TTL', 60 * 60))
+CACHE_MAX_BYTES = int(os.environ.get('SIM_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+# keys are spread over a fixed number of lock files
+N_LOCKS = 64
+# the worker computing a key renews its claim on it, a claim that isn't renewed for this long has lost its worker
+CLAIM_TIMEOUT = 30
+WAIT_INTERVAL = 0.5
+
+_thread_locks = [threading.Lock() for i in range(N_LOCKS)]
+_local = threading.local()
+
+
+def make_key(**inputs):
+    # the same inputs always give the same key, whatever types the callback passed in
+    canonical = json.dumps(canonical_form(inputs), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def canonical_form(value):
+    if isinstance(value, dict):
+        return {str(k): canonical_form(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [canonical_form(v) for v in value]
+    if value is None or isinstance(value, bool):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def get_or_compute(key, compute, on_wait=None, counted=True):
+    # only one process computes a key, everyone else waits for it and then reads the cache
+    # on_wait is called while waiting, e.g. to show the waiter is still alive
+    # uncounted when the request that asked for the key already counted it
+    result = lookup(key, counted)
+    while result is None:
+        if claim(key):
+            break
+        if on_wait is not None:
+            on_wait()
+        time.sleep(WAIT_INTERVAL)
+        result = lookup(key)
+    if result is not None:
+        return result
+
+    try:
+        with renewing_claim(key):
+            result = compute()
+        store(key, result)
+    finally:
+        release(key)
+    return result
+
+
+def claim(key):
+    # the key's lock is only held while claiming it, not while it's computed, as unrelated keys share locks
+    with key_lock(key):
+        if contains(key):
+            return False
+        now = time.time()
+        with connect() as conn:
+            conn.execute('DELETE FROM claims WHERE key = ? AND updated < ?', (key, now - CLAIM_TIMEOUT))
+            return conn.execute('INSERT OR IGNORE INTO claims VALUES (?, ?)', (key, now)).rowcount == 1
+
+
+@contextmanager
+def renewing_claim(key):
+    # renewed from its own thread, however long the computation goes without reporting
+    stopped = threading.Event()
+
+    def renew():
+        while not stopped.wait(CLAIM_TIMEOUT / 4):
+            with connect() as conn:
+                conn.execute('UPDATE claims SET updated = ? WHERE key = ?', (time.time(), key))
+
+    thread = threading.Thread(target=renew, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stopped.set()
+        thread.join()
+
+
+def release(key):
+    with connect() as conn:
+        conn.execute('DELETE FROM claims WHERE key = ?', (key,))
+
+
+def lookup(key, counted=False):
+    # counted as a hit or miss when a request asks for a run, not when it rereads one it already has
+    now = time.time()
+    with connect() as conn:
+        row = conn.execute('SELECT value, created FROM entries WHERE key = ?', (key,)).fetchone()
+        found = row is not None and now - row[1] <= CACHE_TTL
+        if found:
+            conn.execute('UPDATE entries SET accessed = ? WHERE key = ?', (now, key))
+    if counted:
+        count('hits' if found else 'misses')
+    return pickle.loads(row[0]) if found else None
+
+
+def contains(key, counted=False):
+    # without loading the result
+    with connect() as conn:
+        row = conn.execute('SELECT created FROM entries WHERE key = ?', (key,)).fetchone()
+    found = row is not None and time.time() - row[0] <= CACHE_TTL
+    if counted:
+        count('hits' if found else 'misses')
+    return found
+
+
+def store(key, result):
+    value = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+    now = time.time()
+    with connect() as conn:
+        conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)', (key, value, len(value), now, now))
+        evict(conn, now)
+
+
+def evict(conn, now):
+    conn.execute('DELETE FROM entries WHERE created < ?', (now - CACHE_TTL,))
+    # then the least recently used entries until we are back under the size limit
+    total = 0
+    for key, size in conn.execute('SELECT key, size FROM entries ORDER BY accessed DESC').fetchall():
+        total += size
+        if total > CACHE_MAX_BYTES:
+            conn.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+
+def count(name):
+    with connect() as conn:
+        conn.execute('INSERT OR IGNORE INTO stats VALUES (?, 0)', (name,))
+        conn.execute('UPDATE stats SET count = count + 1 WHERE name = ?', (name,))
+
+
+def get_stats():
+    with connect() as conn:
+        stats = {'hits': 0, 'misses': 0}
+        stats.update(dict(conn.execute('SELECT name, count FROM stats').fetchall()))
+        stats['entries'], stats['bytes'] = \
+            conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+    return stats
+
+
+def clear():
+    with connect() as conn:
+        conn.execute('DELETE FROM entries')
+        conn.execute('DELETE FROM stats')
+        conn.execute('DELETE FROM claims')
+
+
+@contextmanager
+def key_lock(key):
+    index = int(key[:8], 16) % N_LOCKS
+    with _thread_locks[index]:
+        if fcntl is None:
+            yield
+            return
+        make_cache_dir()
+        with open(os.path.join(CACHE_DIR, 'lock-{}'.format(index)), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def connect():
+    with connect_db('cache.sqlite', ['CREATE TABLE IF NOT EXISTS entries '
+                                     '(key TEXT PRIMARY KEY, value BLOB, size INTEGER, created REAL, accessed REAL)',
+                                     'CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, count INTEGER)',
+                                     'CREATE TABLE IF NOT EXISTS claims (key TEXT PRIMARY KEY, updated REAL)']) as conn:
+        yield conn
+
+
+@contextmanager
+def connect_db(name, tables):
+    # each thread keeps its connections open, and a forked child opens its own - closing the last connection
+    # to a WAL database checkpoints and deletes the log, which costs far more than the queries
+    # committed on success
+    path = os.path.join(CACHE_DIR, name)
+    if getattr(_local, 'pid', None) != os.getpid():
+        _local.connections = {}
+        _local.pid = os.getpid()
+    conn = _local.connections.get(path)
+    if conn is None:
+        make_cache_dir()
+        conn = sqlite3.connect(path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL')
+        for table in tables:
+            conn.execute(table)
+        conn.commit()
+        _local.connections[path] = conn
+    try:
+        yield conn
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+
+
+def make_cache_dir():
+    # refuses a directory anyone else could have planted entries in
+    os.makedirs(CACHE_DIR, mode=0o700, exist_ok=True)
+    if hasattr(os, 'getuid'):
+        info = os.stat(CACHE_DIR)
+        if info.st_uid != os.getuid() or info.st_mode & 0o022:
+            raise PermissionError('The cache directory {} must belong to this user and only be writable by '
+                                  'it'.format(CACHE_DIR))
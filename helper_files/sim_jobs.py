@@ -0,0 +1,139 @@
+import json
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+from helper_files import metrics, sim_cache
+from helper_files.simulation import run_simulation
+
+# simulations run on threads in the worker that took the click, progress goes where every worker can see it
+JOB_THREADS = int(os.environ.get('SIM_JOB_THREADS', 2))
+# a running job that hasn't reported for this long has lost its worker - queued jobs don't report, they only wait
+# for a thread
+JOB_TIMEOUT = 120
+JOB_KEEP = 24 * 60 * 60
+PROVISIONAL_PERCENTILES = [10, 25, 50, 75, 90]
+
+_executor = None
+_executor_pid = None
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def submit_job(key, n_trials, model, seed=None, options=None, tolerance=None):
+    job_id = uuid.uuid4().hex
+    now = time.time()
+    with connect() as conn:
+        conn.execute('DELETE FROM jobs WHERE updated < ?', (now - JOB_KEEP,))
+        conn.execute('INSERT INTO jobs VALUES (?, ?, ?, 0, ?, NULL, ?)', (job_id, key, 'queued', n_trials, now))
+    get_executor().submit(run_job, job_id, key, n_trials, model, seed, options, tolerance)
+    return job_id
+
+
+def run_job(job_id, key, n_trials, model, seed, options, tolerance):
+    metrics.start('job')
+    strat_ages = model[1]
+    metrics.count('years', strat_ages[-1] - strat_ages[0])
+    try:
+        # a job cancelled while it was queued is never run
+        if not update_job(job_id, status='running', only_if=['queued']):
+            metrics.set_kind('cancelled job')
+            return
+        sim = sim_cache.get_or_compute(key, lambda: simulate_in_batches(job_id, n_trials, model, seed, options,
+                                                                        tolerance),
+                                       on_wait=lambda: wait_for_key(job_id), counted=False)
+        metrics.count('trials', sim['n_trials'])
+        update_job(job_id, status='done', done=sim['n_trials'], only_if=['running'])
+    except JobCancelled:
+        metrics.set_kind('cancelled job')
+    except Exception:
+        metrics.set_kind('failed job')
+        update_job(job_id, status='failed')
+        raise
+    finally:
+        metrics.finish()
+
+
+def simulate_in_batches(job_id, n_trials, model, seed, options, tolerance):
+    # after each batch check for a cancel and publish the percentiles so far
+    def on_batch(totals, precision):
+        if get_job(job_id)['status'] == 'cancelled':
+            raise JobCancelled()
+        percentiles = totals.percentiles(PROVISIONAL_PERCENTILES).tolist()
+        provisional = {'percentiles': dict(zip(PROVISIONAL_PERCENTILES, percentiles)),
+                       'precision': precision if tolerance is not None and np.isfinite(precision) else None}
+        update_job(job_id, done=totals.count, provisional=provisional)
+
+    return run_simulation(n_trials, *model, seed=seed, options=options, tolerance=tolerance, on_batch=on_batch)
+
+
+def wait_for_key(job_id):
+    # while another job computes the same key this one is still alive, and can still be cancelled
+    if get_job(job_id)['status'] == 'cancelled':
+        raise JobCancelled()
+    update_job(job_id, only_if=['running'])
+
+
+def get_job(job_id):
+    with connect() as conn:
+        row = conn.execute('SELECT key, status, done, n_trials, provisional, updated FROM jobs WHERE id = ?',
+                           (job_id,)).fetchone()
+    if row is None:
+        return {'status': 'missing'}
+    key, status, done, n_trials, provisional, updated = row
+    if status == 'running' and time.time() - updated > JOB_TIMEOUT:
+        status = 'failed'
+    provisional = json.loads(provisional) if provisional else {'percentiles': None, 'precision': None}
+    percentiles = provisional['percentiles']
+    return {'key': key, 'status': status, 'done': done, 'n_trials': n_trials, 'progress': done / n_trials * 100,
+            'provisional': {int(k): v for k, v in percentiles.items()} if percentiles else None,
+            'precision': provisional['precision']}
+
+
+def cancel_job(job_id):
+    update_job(job_id, status='cancelled', only_if=['queued', 'running'])
+
+
+def update_job(job_id, status=None, done=None, provisional=None, only_if=None):
+    # only_if is the statuses the job can be changed from, whether it was changed is returned
+    updates = ['updated = ?']
+    values = [time.time()]
+    if status is not None:
+        updates.append('status = ?')
+        values.append(status)
+    if done is not None:
+        updates.append('done = ?')
+        values.append(done)
+    if provisional is not None:
+        updates.append('provisional = ?')
+        values.append(json.dumps(provisional))
+    query = 'UPDATE jobs SET ' + ', '.join(updates) + ' WHERE id = ?'
+    values.append(job_id)
+    if only_if is not None:
+        query += ' AND status IN ({})'.format(', '.join('?' * len(only_if)))
+        values += only_if
+    with connect() as conn:
+        return conn.execute(query, values).rowcount == 1
+
+
+def get_executor():
+    # made on first use so each gunicorn worker has its own threads
+    global _executor, _executor_pid
+    if _executor is None or _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(max_workers=JOB_THREADS)
+        _executor_pid = os.getpid()
+    return _executor
+
+
+@contextmanager
+def connect():
+    with sim_cache.connect_db('jobs.sqlite', ['CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, key TEXT, '
+                                              'status TEXT, done INTEGER, n_trials INTEGER, provisional TEXT, '
+                                              'updated REAL)']) as conn:
+        yield conn
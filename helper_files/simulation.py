@@ -0,0 +1,318 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from helper_files import history, metrics, sim_cache
+from helper_files.financial_calcs import BLOCK_SIZE, TIMESTEPS, simulate_blocks, simulate_scenario_blocks, \
+    simulate_drawdown_blocks, get_batch_apr, new_seed
+from helper_files.quantiles import BlockEstimates, make_quantiles
+
+MAX_TRIALS = 100000000
+# bump this whenever the shape of a simulation result changes so old cache entries aren't used
+RESULT_VERSION = 5
+SUMMARY_PERCENTILES = [10, 25, 50, 75, 90]
+SAMPLING_SCHEMES = {'iid': 'Random', 'antithetic': 'Antithetic pairs', 'sobol': 'Sobol (quasi-random)'}
+TIMESTEP_LABELS = {'yearly': 'Yearly steps', 'monthly': 'Monthly steps'}
+RETURN_MODELS = {'normal': 'Normal returns',
+                 'bootstrap': 'Historical returns ({} year blocks)'.format(history.BLOCK_YEARS)}
+# trials are run, and summarised, this many blocks at a time so memory doesn't grow with the trial count
+MAX_BATCH_BLOCKS = 256
+# an adaptive run always does this many blocks before trusting the spread between them
+MIN_ADAPTIVE_BLOCKS = 10
+ADAPTIVE_PERCENTILES = [10, 50, 90]
+CI_Z = 1.96
+# a sweep compares static allocations from all stocks to all bonds
+SWEEP_BONDS = list(range(0, 101, 5))
+SWEEP_MAX_TRIALS = 20000
+# runs at least this big are split across a pool of processes
+PARALLEL_MIN_TRIALS = int(os.environ.get('SIM_PARALLEL_MIN_TRIALS', 200000))
+# every gunicorn worker (WEB_CONCURRENCY of them, gunicorn's own default) has its own pool, so they share the cores
+SIM_PROCESSES = int(os.environ.get('SIM_PROCESSES',
+                                   max(1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY', 1)))))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def run_simulation(n_trials, principal, strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd,
+                   seed=None, options=None, tolerance=None, on_batch=None):
+    # the distributions of the final total and annualised return over every trial
+    # options are passed on to the model, e.g. {'sampling': 'antithetic'}, apart from a drawdown, e.g.
+    # {'rate': 0.05, 'until': 95}, which withdraws that share of the final total every year until that age
+    # with a tolerance n_trials is only a cap - batches are run until the confidence intervals of the
+    # 10th, 50th and 90th percentiles are all narrower than that fraction of the percentile
+    seed = new_seed() if seed is None else seed
+    options = options or {}
+    model_options, drawdown = split_options(options)
+    model = (principal, strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd)
+    depletion = Depletion(drawdown, strat_ages[-1])
+    totals = make_quantiles(n_trials, seed)
+    aprs = make_quantiles(n_trials, seed)
+    block_estimates = BlockEstimates(SUMMARY_PERCENTILES, BLOCK_SIZE)
+    total_blocks = get_n_blocks(n_trials)
+    # decided on the whole run, its batches are only a fraction of it
+    parallel = is_parallel(n_trials)
+    first_block = 0
+    precision = None
+    while first_block < total_blocks:
+        if tolerance is None:
+            n_blocks = get_batch_blocks(n_trials)
+        else:
+            n_blocks = get_adaptive_blocks(first_block, precision, tolerance)
+        n_blocks = min(n_blocks, total_blocks - first_block)
+        batch_totals, batch_aprs, total_paid_in = simulate_range(seed, first_block, n_blocks, n_trials, model,
+                                                                 parallel, model_options)
+        depletion.update(seed, first_block, n_blocks, n_trials, model, model_options)
+        with metrics.stage('quantiles'):
+            totals.update(batch_totals)
+            aprs.update(batch_aprs)
+            block_estimates.update(batch_totals)
+            first_block += n_blocks
+            precision = get_precision(totals, block_estimates)
+        if on_batch is not None:
+            on_batch(totals, max(precision.values()))
+        if tolerance is not None and max(precision.values()) <= tolerance:
+            break
+    return {'totals': totals,
+            'aprs': aprs,
+            'standard_errors': block_estimates.standard_errors(),
+            'precision': precision,
+            'n_trials': totals.count,
+            'tolerance': tolerance,
+            'total_paid_in': total_paid_in,
+            'drawdown': depletion.summary(),
+            'seed': seed,
+            'options': options,
+            # enough to simulate the same trials again, see helper_files/export.py
+            'model': model,
+            'n_simulated': min(n_trials, first_block * BLOCK_SIZE)}
+
+
+def run_scenarios(n_trials, models, seed=None, options=None):
+    # several models over the same n_trials in one vectorised batch - each result is the one run_simulation
+    # would give for that model on its own
+    seed = new_seed() if seed is None else seed
+    options = options or {}
+    model_options, drawdown = split_options(options)
+    depletions = [Depletion(drawdown, model[1][-1]) for model in models]
+    totals = [make_quantiles(n_trials, seed) for model in models]
+    aprs = [make_quantiles(n_trials, seed) for model in models]
+    block_estimates = [BlockEstimates(SUMMARY_PERCENTILES, BLOCK_SIZE) for model in models]
+    total_blocks = get_n_blocks(n_trials)
+    batch_blocks = get_batch_blocks(n_trials)
+    for first_block in range(0, total_blocks, batch_blocks):
+        n_blocks = min(batch_blocks, total_blocks - first_block)
+        with metrics.stage('trials'):
+            final_totals, total_paid_in, payment_coeffs = simulate_scenario_blocks(seed, first_block, n_blocks,
+                                                                                   n_trials, models,
+                                                                                   **model_options)
+        with metrics.stage('apr'):
+            batch_aprs = get_batch_apr(payment_coeffs[:, None, :], final_totals,
+                                       steps_per_year=TIMESTEPS[options.get('timestep', 'yearly')])
+        with metrics.stage('quantiles'):
+            for i in range(len(models)):
+                totals[i].update(final_totals[i])
+                aprs[i].update(batch_aprs[i])
+                block_estimates[i].update(final_totals[i])
+        for model, depletion in zip(models, depletions):
+            depletion.update(seed, first_block, n_blocks, n_trials, model, model_options)
+    return [{'totals': totals[i],
+             'aprs': aprs[i],
+             'standard_errors': block_estimates[i].standard_errors(),
+             'precision': get_precision(totals[i], block_estimates[i]),
+             'n_trials': totals[i].count,
+             'tolerance': None,
+             'total_paid_in': float(total_paid_in[i]),
+             'drawdown': depletions[i].summary(),
+             'seed': seed,
+             'options': options,
+             'model': models[i],
+             'n_simulated': n_trials} for i in range(len(models))]
+
+
+def get_or_run_scenarios(n_trials, models, seed=None, options=None):
+    # scenarios share the simulation cache with the app, only the ones missing from it are run - all in one batch
+    # every scenario is run over the same trials, cached or not
+    seed = get_sweep_seed(n_trials, models, options) if seed is None else seed
+    keys = [get_sim_key(n_trials, model, seed, options) for model in models]
+    sims = [sim_cache.lookup(key, counted=True) for key in keys]
+    missing = [i for i, sim in enumerate(sims) if sim is None]
+    if missing:
+        new_sims = run_scenarios(n_trials, [models[i] for i in missing], seed, options)
+        for i, sim in zip(missing, new_sims):
+            sim_cache.store(keys[i], sim)
+            sims[i] = sim
+    return sims
+
+
+def get_sweep_seed(n_trials, models, options=None):
+    # a sweep without a seed gets one from its inputs, so repeating it is served from the cache as an unseeded
+    # single run is
+    unseeded_keys = [get_sim_key(n_trials, model, options=options) for model in models]
+    return int(sim_cache.make_key(keys=unseeded_keys)[:8], 16)
+
+
+def get_sweep_models(model, bond_grid=SWEEP_BONDS):
+    # the model with every strategy row held at each bond % of the grid in turn
+    principal, strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd = model
+    return [(principal, strat_ages, monthly, [bonds] * len(bond_vals), stock_gain, stock_sd, bond_gain, bond_sd)
+            for bonds in bond_grid]
+
+
+def get_batch_blocks(n_trials, min_batches=10):
+    # a fixed run is split into at least min_batches batches
+    return min(MAX_BATCH_BLOCKS, max(1, -(-get_n_blocks(n_trials) // min_batches)))
+
+
+def get_adaptive_blocks(n_blocks_done, precision, tolerance):
+    # the intervals shrink with the square root of the trials, so aim straight for the tolerance, but never
+    # more than double the run in one go in case the first estimates were off
+    if n_blocks_done < MIN_ADAPTIVE_BLOCKS:
+        return MIN_ADAPTIVE_BLOCKS - n_blocks_done
+    needed = n_blocks_done * (max(precision.values()) / tolerance) ** 2 - n_blocks_done
+    return int(np.clip(np.ceil(needed), 1, min(n_blocks_done, MAX_BATCH_BLOCKS)))
+
+
+def get_precision(totals, block_estimates):
+    # half width of each percentile's 95% confidence interval as a fraction of the percentile
+    standard_errors = block_estimates.standard_errors()
+    estimates = totals.percentiles(ADAPTIVE_PERCENTILES)
+    precision = {}
+    for percentile, estimate in zip(ADAPTIVE_PERCENTILES, estimates):
+        half_width = CI_Z * standard_errors[percentile]
+        precision[percentile] = float(half_width / abs(estimate)) if estimate and not np.isnan(half_width) else np.inf
+    return precision
+
+
+def get_options(sampling='iid', timestep='yearly', returns='normal', drawdown=None):
+    # the defaults are left out so runs keep the cache keys they had before these options
+    options = {'sampling': sampling}
+    if timestep != 'yearly':
+        options['timestep'] = timestep
+    if returns != 'normal':
+        options['returns'] = returns
+    if drawdown is not None:
+        options['drawdown'] = drawdown
+    return options
+
+
+def split_options(options):
+    # the options the model takes, and the drawdown that's run after it
+    model_options = {name: value for name, value in options.items() if name != 'drawdown'}
+    return model_options, options.get('drawdown')
+
+
+class Depletion:
+    # counts the trials whose money runs out in each year of the drawdown
+    def __init__(self, drawdown, end_age):
+        self.drawdown = drawdown
+        self.end_age = end_age
+        self.n_years = max(drawdown['until'] - end_age, 0) if drawdown is not None else 0
+        self.counts = np.zeros(self.n_years, dtype=int)
+        self.n_trials = 0
+
+    def update(self, seed, first_block, n_blocks, n_trials, model, model_options):
+        if self.drawdown is None:
+            return
+        with metrics.stage('drawdown'):
+            depleted = simulate_drawdown_blocks(seed, first_block, n_blocks, n_trials, model, self.drawdown['rate'],
+                                                self.n_years, **model_options)
+            self.counts += np.bincount(depleted[np.isfinite(depleted)].astype(int), minlength=self.n_years)
+            self.n_trials += len(depleted)
+
+    def summary(self):
+        if self.drawdown is None:
+            return None
+        return {'rate': self.drawdown['rate'], 'start_age': self.end_age, 'until': self.drawdown['until'],
+                'ruin_probability': self.counts.sum() / self.n_trials if self.n_trials else 0.0,
+                'depleted': self.counts.tolist()}
+
+
+def get_sim_key(n_trials, model, seed=None, options=None, tolerance=None):
+    # bootstrapped runs go stale when the historical returns change
+    data = {'history': history.get_version()} if (options or {}).get('returns') == 'bootstrap' else {}
+    if len(model) == 6:
+        # an asset model, see get_asset_model
+        principal, strat_ages, monthly, weights, means, cov = model
+        return sim_cache.make_key(n_times=n_trials, principal=principal, strat_ages=strat_ages, monthly=monthly,
+                                  weights=weights, means=means, cov=cov, seed=seed, options=options or {},
+                                  tolerance=tolerance, version=RESULT_VERSION, **data)
+    principal, strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd = model
+    return sim_cache.make_key(n_times=n_trials, principal=principal, strat_ages=strat_ages, monthly=monthly,
+                              bond_vals=bond_vals, stock_gain=stock_gain, stock_sd=stock_sd, bond_gain=bond_gain,
+                              bond_sd=bond_sd, seed=seed, options=options or {}, tolerance=tolerance,
+                              version=RESULT_VERSION, **data)
+
+
+def is_parallel(n_trials):
+    return n_trials >= PARALLEL_MIN_TRIALS and SIM_PROCESSES > 1
+
+
+def simulate_range(seed, first_block, n_blocks, n_trials, model, parallel, options):
+    # the trials in a range of blocks, spread across the process pool for a parallel run
+    if parallel and n_blocks > 1:
+        with metrics.stage('sharded trials'):
+            return run_sharded(seed, first_block, n_blocks, n_trials, model, options)
+    return simulate_shard(seed, first_block, n_blocks, n_trials, model, options)
+
+
+def simulate_shard(seed, first_block, n_blocks, n_trials, model, options):
+    with metrics.stage('trials'):
+        final_totals, total_paid_in, payment_coeffs = simulate_blocks(seed, first_block, n_blocks, n_trials, model,
+                                                                      **options)
+    with metrics.stage('apr'):
+        aprs = get_batch_apr(payment_coeffs, final_totals, steps_per_year=TIMESTEPS[options.get('timestep', 'yearly')])
+    return final_totals, aprs, total_paid_in
+
+
+def get_n_blocks(n_trials):
+    return -(-n_trials // BLOCK_SIZE)
+
+
+def run_sharded(seed, first_block, n_blocks, n_trials, model, options):
+    # each process writes its trials straight into shared arrays, only the paid in total comes back pickled
+    range_start = first_block * BLOCK_SIZE
+    range_trials = min(n_trials, (first_block + n_blocks) * BLOCK_SIZE) - range_start
+    n_shards = min(n_blocks, SIM_PROCESSES * 2)
+    shard_edges = np.linspace(first_block, first_block + n_blocks, n_shards + 1).astype(int)
+    shared = [shared_memory.SharedMemory(create=True, size=range_trials * 8) for i in range(2)]
+    try:
+        futures = [get_pool().submit(fill_shard, shared[0].name, shared[1].name, range_start, range_trials, seed,
+                                     shard_start, shard_end - shard_start, n_trials, model, options)
+                   for shard_start, shard_end in zip(shard_edges[:-1], shard_edges[1:])]
+        total_paid_in = [future.result() for future in futures][0]
+        final_totals, aprs = [np.ndarray(range_trials, dtype=float, buffer=shm.buf).copy() for shm in shared]
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+    return final_totals, aprs, total_paid_in
+
+
+def fill_shard(totals_name, aprs_name, range_start, range_trials, seed, first_block, n_blocks, n_trials, model,
+               options):
+    final_totals, aprs, total_paid_in = simulate_shard(seed, first_block, n_blocks, n_trials, model, options)
+    start = first_block * BLOCK_SIZE - range_start
+    for name, values in [(totals_name, final_totals), (aprs_name, aprs)]:
+        shm = shared_memory.SharedMemory(name=name)
+        shared_values = np.ndarray(range_trials, dtype=float, buffer=shm.buf)
+        shared_values[start:start + len(values)] = values
+        del shared_values
+        shm.close()
+    return total_paid_in
+
+
+def get_pool():
+    # one pool per gunicorn worker, made on first use so it's never inherited through a fork
+    # locked as the job threads can both ask for it first
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ProcessPoolExecutor(max_workers=SIM_PROCESSES, mp_context=multiprocessing.get_context('spawn'))
+            _pool_pid = os.getpid()
+        return _pool
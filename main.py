@@ -10,20 +10,31 @@ import dash_core_components as dcc
 from dash.dependencies import Input, Output, State
 from dash.dependencies import Output,Input,State, MATCH, ALL, ALLSMALLER
 import dash._callback_context as call_back
-import plotly.express as px
 from dash.exceptions import PreventUpdate
 from dash import no_update
 import dash_table
-import numpy as np
-from textwrap import dedent
 
+import functools
 import json
+import os
+
+import plotly
+from flask import jsonify, request, Response, stream_with_context
 
 from helper_files.div_templates import input_card, gain_card, strategy_card, strategy_row, get_concluding_statement, \
-    get_summary_of_sim
+    summarise_sim, summarise_estimate, get_progress_message, get_sweep_table, MAX_STRATEGY_ROWS, TAIL_PERCENTILES
 from helper_files import alerts as alts
+from helper_files import analytic
+from helper_files import api
+from helper_files import export
+from helper_files import history
+from helper_files import metrics
+from helper_files import sim_cache
+from helper_files import sim_jobs
+from helper_files.simulation import MAX_TRIALS, SAMPLING_SCHEMES, SWEEP_BONDS, SWEEP_MAX_TRIALS, TIMESTEP_LABELS, \
+    RETURN_MODELS, get_options, get_sim_key, get_or_run_scenarios, get_sweep_models
 from meta import meta
-from helper_files.financial_calcs import Calculator, get_table_conditions, make_histo, make_box
+from helper_files.financial_calcs import Calculator, TABLE_COLUMNS, TABLE_CONDITIONS, make_histo, make_box
 
 # dash.Dash.index = index
 
@@ -33,7 +44,14 @@ server = app.server
 
 
 app.layout = html.Div([
-    dcc.Store(id='strat-row-index', data=1),
+    dcc.Store(id='strat-row-count', data=1),
+    # the strategy rows as age, monthly and bonds records, top row first
+    dcc.Store(id='strategy', data=[{'age': None, 'monthly': 0, 'bonds': 50}]),
+    dcc.Store(id='sim-job'),
+    # only the cache key of the simulation on show, the views of it are made from the cached trials
+    dcc.Store(id='sim-run'),
+    dcc.Store(id='sim-cancelled'),
+    dcc.Interval(id='sim-poll', interval=500, disabled=True),
 
     dbc.Container(
         [
@@ -50,7 +68,7 @@ app.layout = html.Div([
                             * The volatility of the markets are simulated
                             * Change the ratio of bonds/equities over time
                             * Monthly contributions can be changed over time 
-                            * Simulate the portfolio 10,000 times
+                            * Simulate the portfolio thousands (or millions) of times
                             ''')
                         ]
                     )
@@ -73,6 +91,8 @@ app.layout = html.Div([
                     dcc.Markdown('''
                             * Each yearly bond or stock gain is assumed to be normally distributed
                             * Each yearly gain is independent of any previous year
+                            * Or, with historical returns, each trial strings together random runs of consecutive
+                              years of past bond and stock returns
                             * The entire value of the portfolio is fully invested in the chosen ratio
                                 ''')]
                         ), id='assumptions-list'
@@ -98,12 +118,71 @@ app.layout = html.Div([
                                             [
                                                 dbc.Row(
                                                     [
-                                                        dbc.Col(html.Div(['Simulate portfolio 10,000 times...']), width=6,
+                                                        dbc.Col(html.Div(['Simulate portfolio...',
+                                                                          dbc.Input(type="number", value=10000, min=1,
+                                                                                    max=MAX_TRIALS, step=1000,
+                                                                                    id='num-trials'),
+                                                                          'times']), width=6,
                                                                 className='mt-4'),
                                                         dbc.Col(html.Div([dbc.Button('Simulate', color="dark",
-                                                                                     id='simulate', n_clicks=0)]),
+                                                                                     id='simulate', n_clicks=0),
+                                                                          dbc.Button('Estimate', color="light",
+                                                                                     id='estimate', n_clicks=0,
+                                                                                     className='ml-2'),
+                                                                          dbc.Button('Sweep bonds %', color="light",
+                                                                                     id='sweep', n_clicks=0,
+                                                                                     className='ml-2')]),
                                                                 width=6, className='mt-4'),
                                                     ]
+                                                ),
+                                                dbc.Row(
+                                                    dbc.Col(dbc.Input(type="number", placeholder='Seed (optional)...',
+                                                                      min=0, step=1, id='seed'), width=12,
+                                                            className='mt-2'),
+                                                ),
+                                                dbc.Row(
+                                                    dbc.Col(dbc.Input(type="number",
+                                                                      placeholder='Stop at \u00b1% precision (optional)...',
+                                                                      min=0.01, max=100, step=0.01, id='precision'),
+                                                            width=12, className='mt-2'),
+                                                ),
+                                                dbc.Row(
+                                                    dbc.Col(dbc.Select(options=[{'label': label, 'value': value}
+                                                                                for value, label in
+                                                                                SAMPLING_SCHEMES.items()],
+                                                                       value='iid', id='sampling'), width=12,
+                                                            className='mt-2'),
+                                                ),
+                                                dbc.Row(
+                                                    dbc.Col(dbc.Select(options=[{'label': label, 'value': value}
+                                                                                for value, label in
+                                                                                TIMESTEP_LABELS.items()],
+                                                                       value='yearly', id='timestep'), width=12,
+                                                            className='mt-2'),
+                                                ),
+                                                dbc.Row(
+                                                    # historical returns are only offered with a returns file
+                                                    dbc.Col(dbc.Select(options=[{'label': label, 'value': value}
+                                                                                for value, label in
+                                                                                RETURN_MODELS.items()
+                                                                                if value != 'bootstrap' or
+                                                                                history.is_available()],
+                                                                       value='normal', id='returns'), width=12,
+                                                            className='mt-2'),
+                                                ),
+                                                dbc.Row(
+                                                    [
+                                                        dbc.Col(html.Div(['Then withdraw (% a year)...',
+                                                                          dbc.Input(type="number", value=5, min=0,
+                                                                                    max=100, step=0.1,
+                                                                                    id='withdrawal')]),
+                                                                width=6, className='mt-2'),
+                                                        dbc.Col(html.Div(['...until age',
+                                                                          dbc.Input(type="number", value=95, min=0,
+                                                                                    max=120, step=1,
+                                                                                    id='until-age')]),
+                                                                width=6, className='mt-2'),
+                                                    ]
                                                 )
                                             ]
                                         ),  color='danger', inverse=True
@@ -113,7 +192,8 @@ app.layout = html.Div([
                                             [
                                                 dbc.Row(
                                                     [
-                                                        dbc.Col(html.H5(['Please wait while I calculate...']), width=12,
+                                                        dbc.Col([html.H5(['Please wait while I calculate...']),
+                                                                 html.Div(id='sim-progress')], width=12,
                                                                 className='mt-4'),
                                                     ]
                                                 )
@@ -128,7 +208,8 @@ app.layout = html.Div([
         ),
             dbc.Row(
                 dbc.Col(
-                    dbc.Jumbotron(id='concluding-statement'), width=12, className='mt-4'
+                    dbc.Jumbotron([html.Div(id='concluding-statement'), html.Div(id='sim-statement')]), width=12,
+                    className='mt-4'
                 ), style={'display': 'none'}, id='conc-statement'
             ),
             dbc.Row(
@@ -148,13 +229,43 @@ app.layout = html.Div([
                     ), width=12
                 ), style={'display': 'none'}, id='year-data'
             ),
+            dbc.Row(
+                dbc.Col(
+                        dbc.Card(
+                        dbc.CardBody(
+                            [
+                                html.H4("Risk and return by bonds %", className="card-title"),
+                                html.Div(id='sweep-caption'),
+                                dash_table.DataTable(id='sweep-table',
+                                                     columns=[],
+                                                     data=[],
+                                                     )
+                            ]
+                        ),
+                        className='mt-4',
+                    ), width=12
+                ), style={'display': 'none'}, id='sweep-data'
+            ),
             dbc.Row(
                 [
                     dbc.Col(dbc.Jumbotron([
+                        dbc.Row([
+                            dbc.Col(html.Div(['Histogram bins',
+                                              dbc.Input(type="number", value=20, min=1, max=200, step=1,
+                                                        id='view-bins')]), width=4),
+                            dbc.Col(html.Div(['Leave out the top and bottom (%)',
+                                              dbc.Input(type="number", value=5, min=0, max=49, step=0.5,
+                                                        id='view-trim')]), width=4),
+                            dbc.Col(html.Div(['Outer cards',
+                                              dbc.Select(options=[{'label': 'Bottom and top {}%'.format(tail),
+                                                                   'value': tail} for tail in TAIL_PERCENTILES],
+                                                         value=10, id='view-tail')]), width=4),
+                        ]),
                         dbc.Row([
                             dbc.Col(dcc.Graph(id='histo'), width=6),
                             dbc.Col(dcc.Graph(id='box'), width=6),
-                        ])
+                        ]),
+                        html.Div(id='sim-export'),
                     ]), width=12, className='mt-4')
                 ], style={'display': 'none'}, id='sim-graphs'),
                 dbc.Row(style={'padding-bottom': '500px'}),
@@ -162,134 +273,195 @@ app.layout = html.Div([
         className='mt-4'),
 ])
 
+# the callbacks that only move values around the page run in the browser, so they never wait on a worker
 # checklist for assumuptions check
-@app.callback(
+app.clientside_callback(
+    '''
+    function(value) {
+        return {'display': value.indexOf('see') !== -1 ? 'block' : 'none'};
+    }
+    ''',
     Output('assumptions-list', 'style'),
     [Input('assumptions-check', 'value')]
 )
-def assumptions_check(value):
-    if 'see' in value:
-        return {'display': 'block'}
-    else:
-        return {'display': 'none'}
 
 
 # this adds rows to the strategy
+# only the slot being filled or emptied is sent back, whatever the number of rows
 @app.callback(
-    [Output('strategy-rows', 'children'),
-     Output('strat-row-index', 'data'),
+    [Output({'type': 'strategy-slot', 'index': ALL}, 'children'),
+     Output('strat-row-count', 'data'),
      Output('strategy-row-alert', 'children')],
     [Input('add-strat-row', 'n_clicks'),
      Input('remove-strat-row', 'n_clicks')],
-    [State('strategy-rows', 'children'),
-     State('strat-row-index', 'data'),
+    [State('strat-row-count', 'data'),
      State('monthly-main', 'value')]
 )
-def add_strategy_rows_on_click(add_strat_click, remove_strat_click, existing_rows, index, monthly_main):
+def add_strategy_rows_on_click(add_strat_click, remove_strat_click, n_rows, monthly_main):
     ctx = call_back.callback_context
+    if not ctx.triggered:
+        raise PreventUpdate
+    prop_id = ctx.triggered[0]['prop_id'].split('.')[0]
+    slots = {output['id']['index']: no_update for output in ctx.outputs_list[0]}
     alert = None
-    strategy_rows = None
-    if ctx.triggered:
-        prop_id = ctx.triggered[0]['prop_id'].split('.')[0]
-        if prop_id == 'add-strat-row':
-            # add a strat row
-            strategy_rows = strategy_row(index, None, monthly_main) + existing_rows
-            index += 1
-        elif prop_id == 'remove-strat-row':
-            # remove the first (last added row - if theres more than 1!)
-            if len(existing_rows) > 1:
-                strategy_rows = existing_rows[1:]
-            else:
-                strategy_rows = existing_rows
-        return strategy_rows, index, alert
+    if prop_id == 'add-strat-row':
+        # add a strat row above the others
+        if n_rows < MAX_STRATEGY_ROWS:
+            slots[n_rows] = strategy_row(n_rows, None, monthly_main)
+            n_rows += 1
+        else:
+            alert = alts.too_many_rows
+    elif prop_id == 'remove-strat-row':
+        # remove the first (last added row - if theres more than 1!)
+        if n_rows > 1:
+            n_rows -= 1
+            slots[n_rows] = []
     else:
         raise PreventUpdate
+    return list(slots.values()), n_rows, alert
+
+
+# keep the strategy store in step with the rows
+app.clientside_callback(
+    '''
+    function(ages, monthly, bonds) {
+        return ages.map(function(age, i) {
+            return {'age': age, 'monthly': monthly[i], 'bonds': bonds[i]};
+        });
+    }
+    ''',
+    Output('strategy', 'data'),
+    [Input({'type': 'age-strategy', 'index': ALL}, 'value'),
+     Input({'type': 'monthly-value', 'index': ALL}, 'value'),
+     Input({'type': 'bond-value', 'index': ALL}, 'value')]
+)
 
 # update the monhtly in the first row only...
-@app.callback(
+app.clientside_callback(
+    '''
+    function(monthly_main) {
+        return monthly_main;
+    }
+    ''',
     Output({'type': 'monthly-value', 'index': 0}, 'value'),
     [Input('monthly-main', 'value')]
 )
-def update_monthly_vals_in_strat_row(monthly_main):
-    return monthly_main
 
 # add the wartning when simulate is clicked
-@app.callback(
+app.clientside_callback(
+    '''
+    function(sim_click, calc_click, poll_disabled) {
+        var triggered = dash_clientside.callback_context.triggered;
+        var prop_id = triggered.length ? triggered[0].prop_id.split('.')[0] : null;
+        var waiting = prop_id === 'simulate' || (prop_id === 'sim-poll' && !poll_disabled);
+        return {'display': waiting ? 'block' : 'none'};
+    }
+    ''',
     Output('wait-message', 'style'),
     [Input('simulate', 'n_clicks'),
-     Input('calculate', 'n_clicks')],
+     Input('calculate', 'n_clicks'),
+     Input('sim-poll', 'disabled')],
 
 )
-def update_bond_values(sim_click, calc_click):
-    ctx = call_back.callback_context
-    prop_id = None
-    if ctx.triggered:
-        prop_id = ctx.triggered[0]['prop_id'].split('.')[0]
-        if prop_id == 'simulate':
-            return {'display': 'block'}
-        else:
-            return {'display': 'none'}
-    else:
-        return {'display': 'none'}
 
 # this updates the bonds ratio for each input in the strategy
-@app.callback(
+app.clientside_callback(
+    '''
+    function(bond_val) {
+        var stock_value = typeof bond_val === 'number' ? 100 - bond_val : 0;
+        if (stock_value > 100 || stock_value < 0) {
+            return [0, %s];
+        }
+        return [stock_value, null];
+    }
+    ''' % json.dumps(alts.stock_value_error, cls=plotly.utils.PlotlyJSONEncoder),
     [Output({'type': 'stock-value', 'index': MATCH}, 'value'),
      Output({'type': 'bond-value-alert', 'index': MATCH}, 'children')],
     [Input({'type': 'bond-value', 'index': MATCH}, 'value')],
 )
-def update_bond_values(bond_val):
-    alert = None
-    try:
-        stock_value = 100 - bond_val
-    except TypeError:
-        stock_value = 0
-    if stock_value > 100 or stock_value < 0:
-        alert = alts.stock_value_error
-        stock_value = 0
-    return stock_value, alert
 
 # do the calculation here and make validation checks....
+MAIN_OUTPUTS = ['strategy-alert.children', 'data-table.columns', 'data-table.data', 'data-table.style_data_conditional',
+                'concluding-statement.children', 'sim-run.data', 'conc-statement.style',
+                'sim-graphs.style', 'year-data.style', 'sim-job.data', 'sim-poll.disabled', 'sim-progress.children',
+                'sweep-table.columns', 'sweep-table.data', 'sweep-caption.children', 'sweep-data.style']
+
+
+def main_outputs(updates):
+    # anything not in updates is left as it is
+    return [updates.get(output, no_update) for output in MAIN_OUTPUTS]
+
+
+def timed_callback(function):
+    # dash turns the outputs into json after the callback returns, that is timed up to the end of the request
+    @functools.wraps(function)
+    def wrapper(*args):
+        outputs = function(*args)
+        metrics.lap('serialize')
+        return outputs
+    return wrapper
+
+
 @app.callback(
-    [Output('strategy-alert', 'children'),
-     Output('data-table', 'columns'),
-     Output('data-table', 'data'),
-     Output('data-table', 'style_data_conditional'),
-     Output('concluding-statement', 'children'),
-     Output('histo', 'figure'),
-     Output('box', 'figure'),
-     Output('conc-statement', 'style'),
-     Output('sim-graphs', 'style'),
-     Output('year-data', 'style')],
+    [Output(*output.split('.')) for output in MAIN_OUTPUTS],
     [Input('calculate', 'n_clicks'),
-     Input('simulate', 'n_clicks')],
+     Input('simulate', 'n_clicks'),
+     Input('sim-poll', 'n_intervals'),
+     Input('sweep', 'n_clicks'),
+     Input('estimate', 'n_clicks')],
     [State('principal', 'value'),
-     State({'type': 'age-strategy', 'index': ALL}, 'value'),
-     State({'type': 'monthly-value', 'index': ALL}, 'value'),
-     State({'type': 'bond-value', 'index': ALL}, 'value'),
-     State({'type': 'stock-value', 'index': ALL}, 'value'),
+     State('strategy', 'data'),
      State('end-age', 'value'),
      State('bond-gain', 'value'),
      State('bond-sd', 'value'),
      State('stock-gain', 'value'),
-     State('stock-sd', 'value')]
+     State('stock-sd', 'value'),
+     State('seed', 'value'),
+     State('num-trials', 'value'),
+     State('sampling', 'value'),
+     State('timestep', 'value'),
+     State('returns', 'value'),
+     State('withdrawal', 'value'),
+     State('until-age', 'value'),
+     State('precision', 'value'),
+     State('sim-job', 'data')]
 )
-def update_bond_values(calc_click, sim_click, principal, strat_ages, monthly_vals, bond_vals, stock_vals, end_age, bond_gain,
-                       bond_sd, stock_gain, stock_sd):
+@timed_callback
+def update_bond_values(calc_click, sim_click, n_intervals, sweep_click, estimate_click, principal, strategy, end_age,
+                       bond_gain, bond_sd, stock_gain, stock_sd, seed, num_trials, sampling, timestep, returns,
+                       withdrawal, until_age, precision, sim_job):
     ctx = call_back.callback_context
     prop_id = None
     if ctx.triggered:
         prop_id = ctx.triggered[0]['prop_id'].split('.')[0]
+    metrics.set_kind(prop_id or 'callback')
+
+    if prop_id == 'sim-poll':
+        return poll_sim_job(sim_job)
 
-    if calc_click > 0 or sim_click > 0:
+    if calc_click > 0 or sim_click > 0 or sweep_click > 0 or estimate_click > 0:
+        metrics.lap('validate')
         alert = alts.invalid_entry
+        strat_ages = [row['age'] for row in strategy]
+        monthly_vals = [row['monthly'] for row in strategy]
+        bond_vals = [row['bonds'] for row in strategy]
         # check if any entry in of the lists is None
         if any(elem is None for elem in monthly_vals + bond_vals + strat_ages):
-            return [alert], no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
+            return main_outputs({'strategy-alert.children': [alert]})
         if '' in monthly_vals:
-            return [alert], no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
+            return main_outputs({'strategy-alert.children': [alert]})
         if end_age is None or principal is None:
-            return [alert], no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
+            return main_outputs({'strategy-alert.children': [alert]})
+        # monthly steps are lognormal, which can't lose everything in a year
+        if prop_id != 'calculate' and timestep == 'monthly' and \
+                any(gain is not None and gain <= -100 for gain in [bond_gain, stock_gain]):
+            return main_outputs({'strategy-alert.children': [alert]})
+        # the estimate is worked out from the normal returns model, historical returns can only be simulated
+        if prop_id == 'estimate' and returns != 'normal':
+            return main_outputs({'strategy-alert.children': [alts.estimate_returns]})
+        # historical returns are resampled at random, and only if there are any
+        if prop_id != 'calculate' and returns == 'bootstrap' and (sampling != 'iid' or not history.is_available()):
+            return main_outputs({'strategy-alert.children': [alts.bootstrap_sampling]})
 
         # now check ages are in correct order
         strat_ages.append(end_age)
@@ -298,35 +470,253 @@ def update_bond_values(calc_click, sim_click, principal, strat_ages, monthly_val
         visible = {'display': 'block'}
         invisible = {'display': 'none'}
         if strat_ages == sorted_list and strat_ages == removed_dupes:
+            metrics.count('years', end_age - strat_ages[0])
+            # the money is drawn down after end_age, if there's an age to draw it down to
+            drawdown = None
+            if withdrawal is not None and until_age is not None and until_age > end_age:
+                drawdown = {'rate': float(withdrawal) / 100, 'until': int(until_age)}
             if prop_id == 'calculate':
+                metrics.lap('calculate')
                 monthly = [float(i) for i in monthly_vals]
-                financial_data = Calculator(float(principal), strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd)
-                df = financial_data.get_df()
-                columns = [{"name": i, "id": i} for i in df.columns]
-                data = df.to_dict('records')
-                conditions = get_table_conditions()
+                financial_data = Calculator(float(principal), strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd,
+                                            seed)
+                columns = [{"name": i, "id": i} for i in TABLE_COLUMNS]
+                data = financial_data.get_records()
+                metrics.lap('statement')
                 concluding_statement = get_concluding_statement(financial_data, end_age)
-                return no_update, columns, data, conditions, concluding_statement, no_update, no_update, visible, invisible, visible
+                return main_outputs({'data-table.columns': columns, 'data-table.data': data,
+                                     'data-table.style_data_conditional': TABLE_CONDITIONS,
+                                     'concluding-statement.children': concluding_statement, 'sim-run.data': None,
+                                     'conc-statement.style': visible, 'sim-graphs.style': invisible,
+                                     'year-data.style': visible, 'sweep-data.style': invisible})
+            elif prop_id == 'sweep':
+                if num_trials is None:
+                    return main_outputs({'strategy-alert.children': [alert]})
+                metrics.lap('sweep')
+                # every allocation is run over the same trials so the differences between them aren't noise
+                monthly = [float(i) for i in monthly_vals]
+                num_trials = min(max(int(num_trials), 1), SWEEP_MAX_TRIALS)
+                metrics.count('trials', num_trials * len(SWEEP_BONDS))
+                model = (float(principal), strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd)
+                sims = get_or_run_scenarios(num_trials, get_sweep_models(model), seed,
+                                            get_options(sampling, timestep, returns, drawdown))
+                metrics.lap('statement')
+                columns, data = get_sweep_table(sims, SWEEP_BONDS)
+                caption = 'Each allocation was simulated over the same {:,} trials (seed {})'.format(
+                    num_trials, sims[0]['seed'])
+                return main_outputs({'sweep-table.columns': columns, 'sweep-table.data': data,
+                                     'sweep-caption.children': caption, 'sweep-data.style': visible,
+                                     'sim-run.data': None,
+                                     'conc-statement.style': invisible, 'sim-graphs.style': invisible,
+                                     'year-data.style': invisible})
+            elif prop_id == 'estimate' or (prop_id == 'simulate' and returns == 'normal' and
+                                           not bond_sd and not stock_sd):
+                # with no volatility every trial would be the same, so there's nothing to simulate
+                metrics.lap('estimate')
+                monthly = [float(i) for i in monthly_vals]
+                model = (float(principal), strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd)
+                if sim_job is not None:
+                    sim_jobs.cancel_job(sim_job['job_id'])
+                estimate = analytic.get_estimate(model, get_options(sampling, timestep, returns, drawdown))
+                metrics.lap('statement')
+                rate = drawdown['rate'] if drawdown is not None else 0.05
+                concluding_statement = summarise_estimate(estimate, float(principal), end_age, rate)
+                return main_outputs({'concluding-statement.children': concluding_statement, 'sim-run.data': None,
+                                     'conc-statement.style': visible, 'sim-graphs.style': invisible,
+                                     'year-data.style': invisible, 'sweep-data.style': invisible,
+                                     'sim-job.data': None, 'sim-poll.disabled': True,
+                                     'sim-progress.children': None})
             elif prop_id == 'simulate':
-                strat_ages.append(end_age)
+                if num_trials is None:
+                    return main_outputs({'strategy-alert.children': [alert]})
                 monthly = [float(i) for i in monthly_vals]
-                num_trials = 10000
-                concluding_statement, totals_df, largest_val, totals_list = \
-                    get_summary_of_sim(num_trials, float(principal), strat_ages, monthly, bond_vals, stock_gain,
-                                       stock_sd, bond_gain, bond_sd)
-                totals_list.sort()
-                totals_list = totals_list[int(num_trials / 20): int(num_trials - num_trials / 20)]
-                hist = make_histo(totals_list, totals_df, num_trials)
-                box = make_box(totals_list)
-
-                return no_update, no_update, no_update, no_update, concluding_statement, hist, box, visible, visible, invisible
+                num_trials = min(max(int(num_trials), 1), MAX_TRIALS)
+                metrics.count('trials', num_trials)
+                model = (float(principal), strat_ages, monthly, bond_vals, stock_gain, stock_sd, bond_gain, bond_sd)
+                metrics.lap('submit')
+                if sim_job is not None:
+                    sim_jobs.cancel_job(sim_job['job_id'])
+
+                # run the simulation in the background and poll for its progress
+                # with a precision the number of trials becomes the most that will be run
+                options = get_options(sampling, timestep, returns, drawdown)
+                tolerance = float(precision) / 100 if precision else None
+                key = get_sim_key(num_trials, model, seed, options, tolerance)
+                # a miss is counted here, the job that computes it doesn't count it again
+                if sim_cache.contains(key, counted=True):
+                    return show_sim(key, float(principal), end_age, None)
+                job_id = sim_jobs.submit_job(key, num_trials, model, seed, options, tolerance)
+                sim_job = {'job_id': job_id, 'principal': float(principal), 'end_age': end_age}
+                outputs = {'sim-job.data': sim_job, 'sim-poll.disabled': False,
+                           'sim-progress.children': get_progress_message(sim_jobs.get_job(job_id))}
+                # the estimate stands in for the simulation until show_sim replaces it
+                estimate = analytic.get_estimate(model, options)
+                if estimate is not None:
+                    rate = drawdown['rate'] if drawdown is not None else 0.05
+                    outputs.update({'concluding-statement.children': summarise_estimate(estimate, float(principal),
+                                                                                        end_age, rate,
+                                                                                        provisional=True),
+                                    'sim-run.data': None, 'conc-statement.style': visible,
+                                    'sim-graphs.style': invisible, 'year-data.style': invisible,
+                                    'sweep-data.style': invisible})
+                return main_outputs(outputs)
         else:
             alert = alts.error_with_ages
-            return [alert], no_update, no_update, no_update, no_update, no_update, no_update, no_update, no_update
+            return main_outputs({'strategy-alert.children': [alert]})
     else:
         raise PreventUpdate
 
 
+def poll_sim_job(sim_job):
+    if sim_job is None:
+        raise PreventUpdate
+    metrics.lap('poll')
+    job = sim_jobs.get_job(sim_job['job_id'])
+    if job['status'] in ['queued', 'running']:
+        return main_outputs({'sim-progress.children': get_progress_message(job)})
+    if job['status'] != 'done' or not sim_cache.contains(job['key']):
+        return main_outputs({'sim-poll.disabled': True, 'sim-progress.children': get_progress_message(job)})
+    return show_sim(job['key'], sim_job['principal'], sim_job['end_age'], sim_job)
+
+
+def show_sim(key, principal, end_age, sim_job):
+    # the statement and figures are drawn by show_sim_views once the run is in the store
+    visible = {'display': 'block'}
+    invisible = {'display': 'none'}
+    sim_run = {'key': key, 'principal': principal, 'end_age': end_age}
+    return main_outputs({'concluding-statement.children': None, 'sim-run.data': sim_run,
+                         'conc-statement.style': visible, 'sim-graphs.style': visible,
+                         'year-data.style': invisible, 'sim-job.data': sim_job, 'sim-poll.disabled': True,
+                         'sim-progress.children': None, 'sweep-data.style': invisible})
+
+
+# the views of a simulation only re-slice its cached trials, changing them never runs it again
+@app.callback(
+    [Output('sim-statement', 'children'),
+     Output('histo', 'figure'),
+     Output('box', 'figure'),
+     Output('sim-export', 'children')],
+    [Input('sim-run', 'data'),
+     Input('view-bins', 'value'),
+     Input('view-trim', 'value'),
+     Input('view-tail', 'value')]
+)
+@timed_callback
+def show_sim_views(sim_run, bins, trim, tail):
+    metrics.set_kind('view')
+    if sim_run is None:
+        return None, no_update, no_update, None
+    if bins is None or trim is None or tail is None:
+        raise PreventUpdate
+    sim = sim_cache.lookup(sim_run['key'])
+    if sim is None:
+        return [alts.sim_expired], no_update, no_update, None
+    metrics.lap('statement')
+    concluding_statement = summarise_sim(sim, sim_run['principal'], sim_run['end_age'], float(tail))
+    metrics.lap('figures')
+    trim = min(max(float(trim), 0), 49) / 100
+    bins = min(max(int(bins), 1), 200)
+    return concluding_statement, make_histo(sim['totals'], trim, bins), make_box(sim['totals'], trim), \
+        get_export_links(sim_run['key'], sim)
+
+
+def get_export_links(key, sim):
+    if not export.is_exportable(sim):
+        return None
+    files = ['manifest.json'] + [name + '.npy' for name in export.ARRAYS]
+    if export.pyarrow is not None:
+        files += ['trials.parquet', 'trials.parquet?paths=1']
+    links = [html.A(name.replace('?paths=1', ' (with yearly totals)'), href='/export/{}/{}'.format(key, name),
+                    className='mr-3') for name in files]
+    return html.Div(['Download every trial: '] + links, style={'font-size': '12px'})
+
+
+# stop a running simulation as soon as any of its inputs change
+@app.callback(
+    Output('sim-cancelled', 'data'),
+    [Input('principal', 'value'),
+     Input('strategy', 'data'),
+     Input('end-age', 'value'),
+     Input('bond-gain', 'value'),
+     Input('bond-sd', 'value'),
+     Input('stock-gain', 'value'),
+     Input('stock-sd', 'value'),
+     Input('seed', 'value'),
+     Input('num-trials', 'value'),
+     Input('sampling', 'value'),
+     Input('timestep', 'value'),
+     Input('returns', 'value'),
+     Input('withdrawal', 'value'),
+     Input('until-age', 'value'),
+     Input('precision', 'value')],
+    [State('sim-job', 'data')]
+)
+def cancel_sim_on_change(*values):
+    sim_job = values[-1]
+    if sim_job is None:
+        raise PreventUpdate
+    sim_jobs.cancel_job(sim_job['job_id'])
+    return sim_job['job_id']
+
+
+# hit/miss counters for the shared simulation cache
+@server.route('/sim-cache/stats')
+def sim_cache_stats():
+    return jsonify(sim_cache.get_stats())
+
+
+# time every callback request, broken down into the stages the callbacks mark
+@server.before_request
+def start_request_metrics():
+    if request.path.endswith('/_dash-update-component'):
+        metrics.start('callback')
+    elif request.path.startswith('/api/'):
+        metrics.start('api')
+
+
+@server.after_request
+def finish_request_metrics(response):
+    metrics.finish()
+    return response
+
+
+# simulations without the app, see helper_files/api.py for the request format
+@server.route('/api/simulate', methods=['POST'])
+def api_simulate():
+    try:
+        return jsonify(api.simulate(request.get_json(silent=True)))
+    except api.ApiError as error:
+        return jsonify({'error': str(error)}), 400
+
+
+# a simulation's trials for offline analysis, see helper_files/export.py for the files
+@server.route('/export/<key>/<filename>')
+def export_run(key, filename):
+    sim = sim_cache.lookup(key)
+    if sim is None or not export.is_exportable(sim):
+        return jsonify({'error': 'This simulation is no longer saved, simulate it again'}), 404
+    name, extension = os.path.splitext(filename)
+    headers = {'Content-Disposition': 'attachment; filename=' + filename}
+    if filename == 'manifest.json':
+        return Response(json.dumps(export.get_manifest(sim, key), indent=2), mimetype='application/json',
+                        headers=headers)
+    if extension == '.npy' and name in export.ARRAYS:
+        headers['Content-Length'] = str(export.get_npy_size(sim, name))
+        return Response(stream_with_context(export.stream_npy(sim, name)), mimetype='application/octet-stream',
+                        headers=headers)
+    if filename == 'trials.parquet':
+        if export.pyarrow is None:
+            return jsonify({'error': 'Parquet exports need pyarrow installed, use the .npy files instead'}), 501
+        return Response(stream_with_context(export.stream_parquet(sim, key, request.args.get('paths') == '1')),
+                        mimetype='application/octet-stream', headers=headers)
+    return jsonify({'error': 'Unknown export ' + filename}), 404
+
+
+# request and stage histograms across every worker, in prometheus text format
+@server.route('/metrics')
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 
 if __name__ == '__main__':
     app.run_server(debug=True)
\ No newline at end of file